@@ -0,0 +1,349 @@
+# Benchmarks of the hot paths of the game and of my_agent over a grid of game settings.
+#
+# Usage:
+#
+#    python benchmark.py                                   # full grid, results saved to benchmark.json
+#    python benchmark.py --lengths 4 5 --colours 6         # part of the grid
+#    python benchmark.py --baseline old.json               # compare with saved results
+#
+# The workloads (codes, candidate pools and target boards) are drawn from the seed in settings.py, so
+# that two runs time exactly the same work. Exits with status 1 if any benchmark is slower than the
+# baseline by more than the threshold.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+from settings import game_settings
+from feedback import code_space, code_space_size, encode, feedback, feedback_pairs, unpack_feedback, MAX_MATRIX_CODES
+import mastermind
+import my_agent
+
+COLOURS = mastermind.COLOURS
+
+def time_call(func, repeat):
+   """ Times repeated calls of a function
+
+         :param func: function with no arguments to time
+
+                repeat: number of calls
+
+         :return: a dictionary with the median, min. and max. time per call in seconds
+         """
+   times = np.zeros(repeat)
+   for r in range(repeat):
+      start = time.perf_counter()
+      func()
+      times[r] = time.perf_counter() - start
+   return {'median': float(np.median(times)), 'min': float(np.min(times)), 'max': float(np.max(times)),
+           'repeat': repeat}
+
+def make_agent(code_length, num_colours, num_guesses):
+   """ Creates a my_agent agent for the given settings """
+   return my_agent.MastermindAgent(code_length=code_length, colours=COLOURS[:num_colours], num_guesses=num_guesses)
+
+def bench_evaluate_guess(rnd, code_length, num_colours, repeat):
+   """ Times mastermind.evaluate_guess on one pair of boards, and the feedback kernel on one guess against
+       the whole code space """
+   colours = np.array(COLOURS[:num_colours])
+   guess = colours[rnd.randint(0, num_colours, size=code_length)]
+   target = colours[rnd.randint(0, num_colours, size=code_length)]
+
+   space = code_space(code_length, num_colours)
+   codes = space.codes(space.indices())
+   counts = space.counts(space.indices())
+   code = encode(guess, colours)
+
+   return {'evaluate_guess': time_call(lambda: mastermind.evaluate_guess(guess, target), repeat),
+           'feedback_kernel': time_call(lambda: feedback(code, codes, num_colours, code_counts=counts), repeat)}
+
+def reference_evaluate_guess(guess, target):
+   """ The per-position evaluation of a guess that the feedback kernel replaced, kept to check the kernel against
+
+         :return: a tuple (in place, in colour)
+         """
+   guess = np.reshape(guess, (-1))
+   target = np.reshape(target, (-1))
+
+   in_place = int(np.count_nonzero(guess == target))
+   I = np.where(guess != target)[0]
+   state = np.zeros(np.shape(target))
+
+   in_colour = 0
+   for i in I:
+      for j in I:
+         if state[j] != 0:
+            continue
+         if target[i] == guess[j]:
+            in_colour += 1
+            state[j] = -1
+            break
+   return in_place, in_colour
+
+def check_feedback(rnd, code_length, num_colours, num_pairs):
+   """ Checks feedback, feedback_pairs and mastermind.evaluate_guess (on colour characters and on colour indices)
+       against reference_evaluate_guess on random pairs of boards
+
+         :return: a dictionary with the number of pairs checked and whether all of them matched
+         """
+   guesses = rnd.randint(0, num_colours, size=(num_pairs, code_length)).astype(np.uint8)
+   targets = rnd.randint(0, num_colours, size=(num_pairs, code_length)).astype(np.uint8)
+   # Guesses that share colours with their targets, which the random pairs above rarely do for many colours
+   guesses[::2] = targets[::2][:, rnd.permutation(code_length)]
+   guesses[::4, 0] = rnd.randint(0, num_colours, size=len(guesses[::4]))
+   colours = np.array(COLOURS[:num_colours])
+
+   expected = [reference_evaluate_guess(guess, target) for guess, target in zip(guesses, targets)]
+   matrix = feedback(guesses, targets, num_colours).reshape(num_pairs, num_pairs)
+   computed = {'feedback': [tuple(int(v) for v in unpack_feedback(matrix[i, i], code_length)) for i in range(num_pairs)],
+               'feedback_pairs': [tuple(int(v) for v in unpack_feedback(score, code_length))
+                                  for score in feedback_pairs(guesses, targets, num_colours)],
+               'evaluate_guess': [mastermind.evaluate_guess(colours[guess], colours[target])
+                                  for guess, target in zip(guesses, targets)],
+               'evaluate_guess_indices': [mastermind.evaluate_guess(guess, target)
+                                          for guess, target in zip(guesses, targets)]}
+
+   # Off-diagonal entries of the matrix against a sample of the reference
+   pairs = rnd.randint(0, num_pairs, size=(min(num_pairs, 50), 2))
+   matches_matrix = all(tuple(int(v) for v in unpack_feedback(matrix[i, j], code_length)) ==
+                        reference_evaluate_guess(guesses[i], targets[j]) for i, j in pairs)
+
+   return {'pairs': num_pairs, 'matches_reference': matches_matrix and all(result == expected
+                                                                            for result in computed.values())}
+
+def bench_update_list(rnd, agent, repeat):
+   """ Times my_agent.update_list on the whole code space """
+   guess = rnd.randint(agent.space.size)
+   target = rnd.randint(agent.space.size)
+   score = my_agent.get_scores(agent, [guess], [target])[0, 0]
+   return {'update_list': time_call(lambda: my_agent.update_list(agent, agent.space.indices(), guess, score), repeat)}
+
+def bench_minimax(rnd, agent, pool_size, repeat):
+   """ Times the minimax functions of my_agent on a random pool of pool_size possible solutions """
+   pool = np.sort(rnd.choice(agent.space.size, size=min(pool_size, agent.space.size), replace=False)).astype(np.int32)
+
+   results = {'minimax_lazy': time_call(lambda: my_agent.minimax_lazy(agent, pool), repeat),
+              'minimax_full': time_call(lambda: my_agent.minimax_full(agent, pool), repeat)}
+   if agent.space.size <= MAX_MATRIX_CODES:
+      results['minimax_full_space'] = time_call(lambda: my_agent.minimax_full(agent, pool, True), repeat)
+      results.update(bench_opening(agent, repeat))
+   results.update(bench_pruning(agent, pool, repeat))
+   return results
+
+def bench_pruning(agent, pool, repeat):
+   """ Times minimax_full with and without pruning (see my_agent.pruned_scores), checks that both pick the same guess,
+       and reports the share of the (guess, possibility) pairs that pruning did not have to score """
+   prune = agent.prune
+   results = {}
+   guesses = {}
+   try:
+      for agent.prune in (False, True):
+         name = 'minimax_pruned' if agent.prune else 'minimax_unpruned'
+         agent.pairs_total = agent.pairs_scored = 0
+         results[name] = time_call(lambda: my_agent.minimax_full(agent, pool), repeat)
+         guesses[agent.prune] = int(my_agent.minimax_full(agent, pool))
+      results['pruning'] = {'rate': 1 - agent.pairs_scored / agent.pairs_total if agent.pairs_total > 0 else 0.0,
+                            'same_guess': guesses[True] == guesses[False]}
+   finally:
+      agent.prune = prune
+   return results
+
+def bench_opening(agent, repeat):
+   """ Times the search for the second guess after the largest score of the first guess, the opening move where
+       the symmetries of the game cut down the guesses to evaluate the most (see my_agent.reduce_guesses) """
+   score, pool = max(agent.after_first_guess_list.items(), key=lambda item: len(item[1]))
+   agent.history = [(agent.first_guess, score)]
+   results = {'minimax_opening': time_call(lambda: my_agent.get_best_guess(agent, pool), repeat)}
+   agent.history = []
+   return results
+
+def bench_play(rnd, code_length, num_colours, num_guesses, num_games):
+   """ Times whole games of my_agent with MastermindGame.play """
+   game = mastermind.MastermindGame(code_length=code_length, num_colours=num_colours)
+   player = mastermind.Player(playerFile='my_agent.py', code_length=code_length, colours=list(game.colours),
+                              num_guesses=num_guesses)
+   boards = rnd.randint(0, num_colours, size=(num_games, code_length)).astype(np.uint8)
+
+   scores = np.zeros(num_games)
+   times = np.zeros(num_games)
+   for i, board in enumerate(boards):
+      start = time.perf_counter()
+      scores[i] = game.play(player, target=board, num_guesses=num_guesses)
+      times[i] = time.perf_counter() - start
+
+   return {'play': {'median': float(np.median(times)), 'min': float(np.min(times)), 'max': float(np.max(times)),
+                    'repeat': num_games},
+           'games_per_second': float(num_games / np.sum(times)),
+           'average_score': float(np.mean(scores))}
+
+def bench_threads(rnd, code_length, num_colours, num_guesses, num_games, num_threads):
+   """ Times games of my_agent played on a pool of threads (see MastermindGame.play_parallel), and checks that every
+       game gets the same score and guesses as when the games are played one after the other """
+   game = mastermind.MastermindGame(code_length=code_length, num_colours=num_colours)
+   player = mastermind.Player(playerFile='my_agent.py', code_length=code_length, colours=list(game.colours),
+                              num_guesses=num_guesses)
+   seed = rnd.randint(2**31)
+
+   start = time.perf_counter()
+   serial = sorted(game.play_range(player, seed, 0, num_games, num_guesses, record=True))
+   serial_time = time.perf_counter() - start
+
+   start = time.perf_counter()
+   threaded = sorted(result for _, result in game.play_parallel(['my_agent.py'], list(game.colours), num_guesses, seed,
+                                                                [(0, num_games)], num_threads, record=True,
+                                                                threads=True))
+   threaded_time = time.perf_counter() - start
+
+   matches = all(a[1] == b[1] and len(a[3]) == len(b[3]) and all(np.array_equal(x, y) for x, y in zip(a[3], b[3]))
+                 for a, b in zip(serial, threaded))
+   return {'play_threads': {'median': threaded_time / num_games, 'repeat': num_games, 'threads': num_threads,
+                            'serial': serial_time / num_games, 'matches_serial': matches}}
+
+def bench_strategies(rnd, code_length, num_colours, num_guesses, num_games):
+   """ Plays the same games with each strategy of my_agent (see my_agent.STRATEGIES), and with the default strategy
+       searched two moves deep (see my_agent.minimax_lookahead), and reports the average number of guesses, the
+       average score (unsolved games count double) and the latency of a move of each """
+   game = mastermind.MastermindGame(code_length=code_length, num_colours=num_colours)
+   boards = rnd.randint(0, num_colours, size=(num_games, code_length)).astype(np.uint8)
+   default = game_settings.get('strategy', 'worst_case'), game_settings.get('lookahead', False)
+
+   results = {}
+   try:
+      for strategy, lookahead in [(strategy, False) for strategy in my_agent.STRATEGIES] + [('worst_case', True)]:
+         game_settings['strategy'] = strategy
+         game_settings['lookahead'] = lookahead
+         player = mastermind.Player(playerFile='my_agent.py', code_length=code_length, colours=list(game.colours),
+                                    num_guesses=num_guesses)
+         game.profiler = mastermind.PlayProfiler()
+         scores = [game.play(player, target=board, num_guesses=num_guesses) for board in boards]
+         moves = game.profiler.report()['agent']['all']
+         name = 'strategy_' + strategy + ('_lookahead' if lookahead else '')
+         results[name] = {'median': moves['p50'], 'mean': moves['mean'], 'p95': moves['p95'], 'max': moves['max'],
+                          'repeat': moves['count'], 'average_guesses': moves['count'] / num_games,
+                          'average_score': float(np.mean(scores))}
+   finally:
+      game_settings['strategy'], game_settings['lookahead'] = default
+   return results
+
+def run_benchmarks(lengths, colours, seed, repeat, pool_size, num_games, max_game_codes, num_threads=2):
+   """ Runs all benchmarks over the grid of settings
+
+         :return: a dictionary of results keyed by "<code length>x<number of colours>"
+         """
+   results = {}
+   for code_length in lengths:
+      for num_colours in colours:
+         key = "%dx%d" % (code_length, num_colours)
+         rnd = np.random.RandomState(seed)
+         num_codes = code_space_size(code_length, num_colours)
+         print("Benchmarking %s (%d codes)..." % (key, num_codes))
+
+         result = {'feedback_reference': check_feedback(rnd, code_length, num_colours, 200)}
+         result.update(bench_evaluate_guess(rnd, code_length, num_colours, repeat))
+
+         start = time.perf_counter()
+         agent = make_agent(code_length, num_colours, game_settings['maxNumberOfGuesses'])
+         result['agent_init'] = {'median': time.perf_counter() - start, 'repeat': 1}
+
+         result.update(bench_update_list(rnd, agent, repeat))
+         result.update(bench_minimax(rnd, agent, pool_size, repeat))
+
+         if num_codes <= max_game_codes:
+            result.update(bench_play(rnd, code_length, num_colours, game_settings['maxNumberOfGuesses'], num_games))
+            result.update(bench_strategies(rnd, code_length, num_colours, game_settings['maxNumberOfGuesses'],
+                                           num_games))
+            result.update(bench_threads(rnd, code_length, num_colours, game_settings['maxNumberOfGuesses'], num_games,
+                                        num_threads))
+
+         results[key] = result
+   return results
+
+def compare(results, baseline, threshold):
+   """ Compares median times with a baseline
+
+         :param results: results of run_benchmarks
+
+                baseline: results of an earlier run
+
+                threshold: relative slow down (0.1 for 10%) above which a benchmark counts as a regression
+
+         :return: a list of (settings, benchmark, baseline time, time) of the regressions
+         """
+   regressions = []
+   for key, result in results.items():
+      for name, value in result.items():
+         if not isinstance(value, dict) or 'median' not in value:
+            continue
+         base = baseline.get(key, {}).get(name)
+         if base is None:
+            continue
+         ratio = value['median'] / base['median'] if base['median'] > 0 else 1.0
+         status = "REGRESSION" if ratio > 1 + threshold else ""
+         print("%-6s %-20s %12.6f s %12.6f s %7.2fx %s" % (key, name, base['median'], value['median'], ratio, status))
+         if ratio > 1 + threshold:
+            regressions.append((key, name, base['median'], value['median']))
+   return regressions
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Benchmarks of the game and my_agent hot paths")
+   parser.add_argument('--lengths', type=int, nargs='+', default=[4, 5, 6, 7, 8], help="code lengths")
+   parser.add_argument('--colours', type=int, nargs='+', default=[3, 4, 5, 6], help="numbers of colours")
+   parser.add_argument('--repeat', type=int, default=10, help="number of timed calls of each function")
+   parser.add_argument('--pool-size', type=int, default=300, help="number of possible solutions given to minimax")
+   parser.add_argument('--games', type=int, default=20, help="number of games played to time play")
+   parser.add_argument('--threads', type=int, default=2, help="number of threads playing games in the thread benchmark")
+   parser.add_argument('--max-game-codes', type=int, default=MAX_MATRIX_CODES,
+                       help="largest code space for which whole games are played")
+   parser.add_argument('--output', default='benchmark.json', help="file the results are saved to")
+   parser.add_argument('--baseline', default=None, help="results of an earlier run to compare with")
+   parser.add_argument('--threshold', type=float, default=0.1, help="relative slow down counted as a regression")
+   args = parser.parse_args(argv)
+
+   # Agents are loaded by file name relative to the working directory
+   os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+   seed = game_settings['seed'] if game_settings['seed'] is not None else 0
+
+   # Benchmarks time the search itself, not moves replayed from a saved strategy book
+   game_settings['strategyBook'] = False
+
+   results = run_benchmarks(args.lengths, args.colours, seed, args.repeat, args.pool_size, args.games,
+                            args.max_game_codes, args.threads)
+
+   # The feedback kernel is also checked beyond the grid, up to the largest codes and number of colours
+   rnd = np.random.RandomState(seed)
+   results['feedback'] = {"%dx%d" % (code_length, num_colours): check_feedback(rnd, code_length, num_colours, 100)
+                          for code_length in range(1, 9) for num_colours in (1, 2, 3, 6, 10, 17, len(COLOURS))}
+
+   mismatches = [key for key, result in results.items() if not result.get('play_threads', {}).get('matches_serial', True)]
+   if len(mismatches) > 0:
+      print("Games played on threads differ from serial games for %s" % ", ".join(mismatches))
+   wrong = [key for key, result in results.items()
+            if key != 'feedback' and not result['feedback_reference']['matches_reference']]
+   wrong += [key for key, result in results['feedback'].items() if not result['matches_reference']]
+   if len(wrong) > 0:
+      print("The feedback kernel differs from the reference evaluation for %s" % ", ".join(wrong))
+
+   report = {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                      'machine': platform.machine(), 'seed': seed, 'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+             'results': results}
+   with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+   print("Results saved to %s" % args.output)
+
+   if args.baseline is not None:
+      with open(args.baseline) as f:
+         baseline = json.load(f)['results']
+      regressions = compare(results, baseline, args.threshold)
+      if len(regressions) > 0:
+         print("%d regression(s) above %.0f%%" % (len(regressions), args.threshold * 100))
+         return 1
+   return 1 if len(mismatches) > 0 or len(wrong) > 0 else 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,364 @@
+import os
+import threading
+import numpy as np
+
+# Codes are handled here as small integers - colour i of the game's colour list is encoded as i - and
+# the feedback of a guess against a code is packed into a single integer
+#
+#    packed = in_place * (code_length + 1) + in_colour
+#
+# which keeps (in_place, in_colour) pairs in lexicographic order and makes them usable as bincount bins.
+
+def num_feedbacks(code_length):
+   """ Returns the number of distinct packed feedback values for a given code length
+
+         :param code_length: the length of the code
+
+         :return: the upper bound (exclusive) on packed feedback values
+         """
+   return (code_length + 1) ** 2
+
+def feedback_dtype(code_length):
+   """ Returns the smallest unsigned integer type that holds packed feedback for a given code length """
+   if num_feedbacks(code_length) <= 256:
+      return np.uint8
+   return np.uint16
+
+def pack_feedback(in_place, in_colour, code_length):
+   """ Packs (in_place, in_colour) into a single integer (works on scalars and arrays)
+
+         :param in_place: number of correct colours in place
+
+                in_colour: number of correct colours out of place
+
+                code_length: the length of the code
+
+         :return: packed feedback value(s)
+         """
+   return in_place * (code_length + 1) + in_colour
+
+def unpack_feedback(packed, code_length):
+   """ Inverse of pack_feedback
+
+         :param packed: packed feedback value(s)
+
+                code_length: the length of the code
+
+         :return: a tuple (in_place, in_colour)
+         """
+   return divmod(packed, code_length + 1)
+
+def code_space_size(code_length, num_colours):
+   """ Returns the number of distinct codes for a given code length and number of colours """
+   return num_colours ** code_length
+
+def all_codes(code_length, num_colours):
+   """ Enumerates the whole code space as integer codes
+
+         The order is the same as that of itertools.product(range(num_colours), repeat=code_length), so that
+         row i of the returned array is the code with index i (first position being the most significant
+         base-num_colours digit).
+
+         :param code_length: the length of the code
+
+                num_colours: the number of colours
+
+         :return: a (num_colours**code_length) x code_length uint8 numpy array of codes
+         """
+   return index_to_codes(np.arange(code_space_size(code_length, num_colours)), code_length, num_colours)
+
+def index_to_codes(indices, code_length, num_colours):
+   """ Decodes code indices into integer codes
+
+         :param indices: an integer or an array of integers in the range [0, num_colours**code_length)
+
+                code_length: the length of the code
+
+                num_colours: the number of colours
+
+         :return: an array of uint8 codes with a trailing dimension of size code_length
+         """
+   indices = np.asarray(indices, dtype=np.int64)
+   powers = num_colours ** np.arange(code_length - 1, -1, -1, dtype=np.int64)
+   return ((indices[..., None] // powers) % num_colours).astype(np.uint8)
+
+def codes_to_index(codes, num_colours):
+   """ Inverse of index_to_codes
+
+         :param codes: an array of integer codes with a trailing dimension of size code_length
+
+                num_colours: the number of colours
+
+         :return: an array of code indices (int64)
+         """
+   codes = np.asarray(codes, dtype=np.int64)
+   code_length = codes.shape[-1]
+   powers = num_colours ** np.arange(code_length - 1, -1, -1, dtype=np.int64)
+   return codes @ powers
+
+def encode(codes, colours):
+   """ Converts codes made of colour characters into integer codes
+
+         :param codes: a list, tuple or numpy array (of any shape) of colour characters
+
+                colours: the list of colour characters; colour colours[i] gets encoded as i
+
+         :return: a uint8 numpy array of the same shape as codes
+         """
+   codes = np.asarray(codes)
+   encoded = np.zeros(np.shape(codes), dtype=np.uint8)
+   for i, c in enumerate(colours):
+      encoded[codes == c] = i
+   return encoded
+
+def decode(codes, colours):
+   """ Converts integer codes back into colour characters
+
+         :param codes: a numpy array of integer codes
+
+                colours: the list of colour characters
+
+         :return: a numpy array of colour characters of the same shape as codes
+         """
+   return np.asarray(colours)[np.asarray(codes)]
+
+def colour_counts(codes, num_colours):
+   """ Counts how many times each colour occurs in each code
+
+         :param codes: an array of integer codes with a trailing dimension of size code_length
+
+                num_colours: the number of colours
+
+         :return: an array of counts with the trailing dimension of size num_colours
+         """
+   codes = np.asarray(codes)
+   return (codes[..., None] == np.arange(num_colours, dtype=codes.dtype)).sum(axis=-2, dtype=np.uint8)
+
+def feedback(guesses, codes, num_colours, guess_counts=None, code_counts=None):
+   """ Scores guesses against codes in a single vectorised call
+
+         The number of correct colours in place is the number of matching positions, and the total number of
+         correct colours (in place or not) is the sum over colours of the minimum of the colour counts in the
+         guess and in the code, so no per-position loop is needed.
+
+         :param guesses: a single integer code (code_length vector) or a G x code_length block of codes
+
+                codes: a single integer code or an N x code_length block of codes
+
+                num_colours: the number of colours
+
+                guess_counts: optional precomputed colour_counts of guesses
+
+                code_counts: optional precomputed colour_counts of codes
+
+         :return: packed feedback; a scalar if both arguments are single codes, an N vector (or G vector) if
+                  one of them is a single code, and a G x N matrix otherwise
+         """
+   guesses = np.asarray(guesses)
+   codes = np.asarray(codes)
+   code_length = guesses.shape[-1]
+
+   if guess_counts is None:
+      guess_counts = colour_counts(guesses, num_colours)
+   if code_counts is None:
+      code_counts = colour_counts(codes, num_colours)
+
+   g = np.reshape(guesses, (-1, 1, code_length))
+   c = np.reshape(codes, (1, -1, code_length))
+   gc = np.reshape(guess_counts, (-1, 1, num_colours))
+   cc = np.reshape(code_counts, (1, -1, num_colours))
+
+   in_place = (g == c).sum(axis=-1, dtype=np.int32)
+   total = np.minimum(gc, cc).sum(axis=-1, dtype=np.int32)
+   packed = pack_feedback(in_place, total - in_place, code_length).astype(feedback_dtype(code_length))
+
+   if guesses.ndim == 1 and codes.ndim == 1:
+      return packed[0, 0]
+   elif guesses.ndim == 1:
+      return packed[0]
+   elif codes.ndim == 1:
+      return packed[:, 0]
+   return packed
+
+# Largest code space for which CodeSpace keeps all codes and their colour counts in memory
+MAX_CACHED_CODES = 2**18
+
+# Code spaces already created by this process
+_code_spaces = {}
+
+class CodeSpace:
+   """ The space of all codes of a game, addressed by code index (see index_to_codes)
+
+         Nothing is enumerated up front.  Codes and colour counts are decoded from indices on demand, or, for
+         spaces of at most MAX_CACHED_CODES codes, computed once on first use and then looked up.  The array of
+         all indices is created on first use and is read-only, so it can be handed out as the initial pool of
+         possible solutions of every game without copying.
+         """
+
+   def __init__(self, code_length, num_colours):
+      """
+      :param code_length: the length of the code
+      :param num_colours: the number of colours
+      """
+      self.code_length = code_length
+      self.num_colours = num_colours
+      self.size = code_space_size(code_length, num_colours)
+      self.index_dtype = np.int32 if self.size < 2**31 else np.int64
+      self.cached = self.size <= MAX_CACHED_CODES
+      self._indices = None
+      self._codes = None
+      self._counts = None
+      self._by_distinct_colours = None
+
+   def __len__(self):
+      return self.size
+
+   def indices(self):
+      """ Returns the read-only array of all code indices """
+      if self._indices is None:
+         self._indices = np.arange(self.size, dtype=self.index_dtype)
+         self._indices.flags.writeable = False
+      return self._indices
+
+   def codes(self, indices):
+      """ Returns the uint8 codes with the given indices (an array with a trailing dimension of code_length) """
+      if self.cached:
+         if self._codes is None:
+            self._codes = all_codes(self.code_length, self.num_colours)
+         return self._codes[indices]
+      return index_to_codes(indices, self.code_length, self.num_colours)
+
+   def counts(self, indices):
+      """ Returns the colour counts of the codes with the given indices """
+      if self.cached:
+         if self._counts is None:
+            self._counts = colour_counts(self.codes(self.indices()), self.num_colours)
+         return self._counts[indices]
+      return colour_counts(self.codes(indices), self.num_colours)
+
+   def by_distinct_colours(self):
+      """ Returns the read-only array of all code indices, codes with more distinct colours first and by increasing
+          index otherwise, computed once on first use """
+      if self._by_distinct_colours is None:
+         distinct = np.concatenate([np.count_nonzero(colour_counts(codes, self.num_colours), axis=1)
+                                    for _, codes in self.chunks()])
+         self._by_distinct_colours = np.argsort(-distinct, kind='stable').astype(self.index_dtype)
+         self._by_distinct_colours.flags.writeable = False
+      return self._by_distinct_colours
+
+   def index(self, codes):
+      """ Returns the indices of uint8 codes """
+      return codes_to_index(codes, self.num_colours)
+
+   def chunks(self, chunk_size=2**16):
+      """ Generates the whole space in chunks of consecutive indices
+
+            :param chunk_size: max. number of codes per chunk
+
+            :return: a generator of (indices, codes) tuples, codes being a uint8 array with a row per index
+            """
+      for start in range(0, self.size, chunk_size):
+         indices = np.arange(start, min(start + chunk_size, self.size), dtype=self.index_dtype)
+         yield indices, self.codes(indices)
+
+def code_space(code_length, num_colours):
+   """ Returns the CodeSpace of the given settings, shared by all callers in the process """
+   key = (code_length, num_colours)
+   if key not in _code_spaces:
+      _code_spaces[key] = CodeSpace(code_length, num_colours)
+   return _code_spaces[key]
+
+def feedback_pairs(guesses, codes, num_colours):
+   """ Scores each guess against the code in the same row
+
+         Unlike feedback, which scores every guess against every code, this pairs up the rows of the two blocks,
+         which is what a batch of games needs (guess of game i against target of game i).
+
+         :param guesses: a B x code_length block of integer codes
+
+                codes: a B x code_length block of integer codes
+
+                num_colours: the number of colours
+
+         :return: a B vector of packed feedback
+         """
+   guesses = np.asarray(guesses)
+   codes = np.asarray(codes)
+   code_length = guesses.shape[-1]
+
+   in_place = (guesses == codes).sum(axis=-1, dtype=np.int32)
+   total = np.minimum(colour_counts(guesses, num_colours), colour_counts(codes, num_colours)).sum(axis=-1,
+                                                                                                 dtype=np.int32)
+   return pack_feedback(in_place, total - in_place, code_length).astype(feedback_dtype(code_length))
+
+# Directory holding the precomputed feedback matrices, one .npy file per (code_length, num_colours)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.feedback_cache')
+
+# Largest code space for which the full feedback matrix is cached (16384 codes is a 256 MB matrix)
+MAX_MATRIX_CODES = 16384
+
+# Matrices already opened by this process
+_matrices = {}
+
+def feedback_matrix_path(code_length, num_colours, cache_dir=None):
+   """ Returns the path of the cached feedback matrix for the given game settings """
+   if cache_dir is None:
+      cache_dir = CACHE_DIR
+   return os.path.join(cache_dir, "feedback_%dx%d.npy" % (code_length, num_colours))
+
+def build_feedback_matrix(path, code_length, num_colours, block_size=512):
+   """ Computes the full feedback matrix and saves it as a .npy file
+
+         The matrix is written block by block into a memory-mapped temporary file, which is then atomically
+         renamed to path, so that processes (or threads) building the same matrix at the same time do not see a
+         partial file.
+
+         :param path: the file to save the matrix to
+
+                code_length: the length of the code
+
+                num_colours: the number of colours
+
+                block_size: number of rows computed per call to the feedback kernel
+         """
+   codes = all_codes(code_length, num_colours)
+   counts = colour_counts(codes, num_colours)
+   num_codes = len(codes)
+
+   os.makedirs(os.path.dirname(path), exist_ok=True)
+   tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+   matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=feedback_dtype(code_length),
+                                      shape=(num_codes, num_codes))
+   for start in range(0, num_codes, block_size):
+      end = min(start + block_size, num_codes)
+      matrix[start:end] = feedback(codes[start:end], codes, num_colours, counts[start:end], counts)
+   matrix.flush()
+   del matrix
+   os.replace(tmp_path, path)
+
+def feedback_matrix(code_length, num_colours, cache_dir=None):
+   """ Returns the read-only, memory-mapped feedback matrix for the given game settings
+
+         Entry [i, j] is the packed feedback of the code with index i guessed against the code with index j
+         (see index_to_codes). The matrix is built on first use and afterwards loaded with np.memmap, so
+         processes using the same settings share its pages through the OS page cache rather than each holding
+         a private copy.
+
+         :param code_length: the length of the code
+
+                num_colours: the number of colours
+
+                cache_dir: directory of the cache, CACHE_DIR if None
+
+         :return: a num_codes x num_codes memory-mapped array, or None if the code space is larger than
+                  MAX_MATRIX_CODES
+         """
+   if code_space_size(code_length, num_colours) > MAX_MATRIX_CODES:
+      return None
+
+   path = feedback_matrix_path(code_length, num_colours, cache_dir)
+   if path not in _matrices:
+      if not os.path.exists(path):
+         build_feedback_matrix(path, code_length, num_colours)
+      _matrices[path] = np.load(path, mmap_mode='r')
+   return _matrices[path]
@@ -4,9 +4,27 @@ __email__ = "lech.szymanski@otago.ac.nz"
 
 import os,sys
 import numpy as np
+import bisect
 import importlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from settings import game_settings
+from feedback import colour_counts, feedback, feedback_pairs, unpack_feedback
+from results import ResultCache, ResultSink
+
+# Colour characters of the game, the first num_colours of which are used
+COLOURS = ['B','R','G','Y','P','C','W','O','K','M','A','D','E','F','H','I','J','L','N','Q','S','T','U','V','X','Z']
+
+# Settings that do not change the outcome of the games (or are passed to run as arguments), left out of the key of
+# the result cache
+UNCACHED_SETTINGS = ('agentFile', 'codeLength', 'numberOfColours', 'maxNumberOfGuesses', 'totalNumberOfGames', 'verbose',
+                     'tournamentAgents', 'numWorkers', 'useThreads', 'batchSize', 'profileFile', 'resultsFile', 'progressInterval',
+                     'quiet', 'moveTimeBudget', 'strictTimeBudget', 'resultCache', 'seed')
 
 class bcolors:
    RED = '\033[1;30;41m'
@@ -15,25 +33,56 @@ class bcolors:
    BLUE = '\033[1;30;44m'
    PURPLE = '\033[1;30;45m'
    CYAN = '\033[1;30;46m'
+   WHITE = '\033[1;30;47m'
+   ORANGE = '\033[1;30;101m'
+   BLACK = '\033[1;37;40m'
+   MAGENTA = '\033[1;30;105m'
    ENDC = '\033[0m'
 
+# Terminal colours of the colour characters; the others are printed as plain characters
+COLOUR_STYLES = {'B': bcolors.BLUE, 'R': bcolors.RED, 'G': bcolors.GREEN, 'Y': bcolors.YELLOW, 'C': bcolors.CYAN,
+                 'P': bcolors.PURPLE, 'W': bcolors.WHITE, 'O': bcolors.ORANGE, 'K': bcolors.BLACK,
+                 'M': bcolors.MAGENTA}
+
 def print_colour_char(c):
-   if c == 'B':
-      sys.stdout.write(f"{bcolors.BLUE}B{bcolors.ENDC}")
-   elif c == 'R':
-      sys.stdout.write(f"{bcolors.RED}R{bcolors.ENDC}")
-   elif c == 'G':
-      sys.stdout.write(f"{bcolors.GREEN}G{bcolors.ENDC}")
-   elif c == 'Y':
-      sys.stdout.write(f"{bcolors.YELLOW}Y{bcolors.ENDC}")
-   elif c == 'C':
-      sys.stdout.write(f"{bcolors.CYAN}C{bcolors.ENDC}")
-   elif c == 'P':
-      sys.stdout.write(f"{bcolors.PURPLE}P{bcolors.ENDC}")
+   style = COLOUR_STYLES.get(c)
+   if style is not None:
+      sys.stdout.write(f"{style}{c}{bcolors.ENDC}")
    else:
        sys.stdout.write("%c" % c)
    sys.stdout.flush()
 
+# Number of target boards generated at a time by MastermindGame.play_range
+BOARD_CHUNK = 4096
+
+def target_boards(seed, games, code_length, num_colours):
+   """ Returns the target boards of the given games of a run
+
+         The board of a game is derived from the seed and the index of the game alone, by hashing (with the
+         splitmix64 finaliser) a counter of the position on the board, so any game of a run can be reproduced without
+         generating the ones before it, and boards can be generated in chunks of any size.
+
+         :param seed: seed of the run
+
+                games: array of game indices
+
+                code_length: the length of the code
+
+                num_colours: the number of colours
+
+         :return: len(games) x code_length uint8 array of colour indices
+         """
+   games = np.asarray(games, dtype=np.uint64).reshape(-1, 1)
+   # In Python integers, which do not overflow (a NumPy integer seed would)
+   key = np.uint64(int(seed) * 0x9E3779B97F4A7C15 % 2**64)
+   z = games * np.uint64(code_length) + np.arange(code_length, dtype=np.uint64) + key
+   z = z + np.uint64(0x9E3779B97F4A7C15)
+   z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+   z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+   z = z ^ (z >> np.uint64(31))
+   # The top 32 bits scaled to [0, num_colours)
+   return (((z >> np.uint64(32)) * np.uint64(num_colours)) >> np.uint64(32)).astype(np.uint8)
+
 def time_to_str(time_in_seconds):
    timeStr = ''
    if time_in_seconds > 3600:
@@ -56,9 +105,11 @@ def time_to_str(time_in_seconds):
 def evaluate_guess(guess,target):
    """ Evaluates a guess against a target
 
-         :param guess: a list or numpy array of valid colour characters that constitutes a guess
+         :param guess: a list or numpy array of valid colour characters that constitutes a guess, or a numpy array
+                       of colour indices
 
-                target: a list or numpy array of valid colour characters that constitutes target solution
+                target: a list or numpy array of valid colour characters that constitutes target solution, or a
+                        numpy array of colour indices
 
 
          :return: a tuple of 2 integers:
@@ -73,30 +124,22 @@ def evaluate_guess(guess,target):
    guess = np.reshape(guess, (-1))
    target = np.reshape(target, (-1))
 
-   I = np.where(guess==target)[0]
-   in_place = len(I)
-   I = np.where(guess!=target)[0]
-   state = np.zeros(np.shape(target))
+   # Colour indices go straight to the feedback kernel
+   if guess.dtype.kind in 'ui' and target.dtype.kind in 'ui':
+      in_place, in_colour = unpack_feedback(feedback(guess, target, int(max(guess.max(), target.max())) + 1),
+                                            len(target))
+      return int(in_place), int(in_colour)
 
-   in_colour = 0
-   for i in I:
-      a = target[i]
-      for j in I:
-         if state[j] != 0:
-            continue
-
-         b = guess[j]
-
-         if a==b:
-            in_colour += 1
-            state[j] = -1
-            break
+   colours = np.unique(np.concatenate((guess, target)))
+   in_place, in_colour = unpack_feedback(feedback(np.searchsorted(colours, guess),
+                                                  np.searchsorted(colours, target),
+                                                  len(colours)), len(target))
 
-   return in_place, in_colour
+   return int(in_place), int(in_colour)
 
 # Class player is a wrapper for a player agent
 class Player:
-   def __init__(self, playerFile,code_length,colours,num_guesses):
+   def __init__(self, playerFile,code_length,colours,num_guesses,time_budget=None):
       self.playerFile = playerFile
 
       if not os.path.exists(playerFile):
@@ -113,17 +156,113 @@ class Player:
       except Exception as e:
          raise RuntimeError(str(e))
 
+      # The time budget per move is passed on to agents that take one
+      kwargs = {}
+      if time_budget is not None and 'time_budget' in inspect.signature(self.exec.MastermindAgent).parameters:
+         kwargs['time_budget'] = time_budget
+
       try:
-         self.agent = self.exec.MastermindAgent(code_length=code_length, colours=colours,num_guesses=num_guesses)
+         self.agent = self.exec.MastermindAgent(code_length=code_length, colours=colours,num_guesses=num_guesses,**kwargs)
       except Exception as e:
          raise RuntimeError(str(e))
 
 
+class PlayProfiler:
+   """ Latency histograms of the phases of a game, per guess index
+
+         MastermindGame.play records the time of each phase of each guess with record:
+
+            agent    - the call to the agent function
+            validate - the checks of the returned action
+            evaluate - scoring the guess against the target
+            output   - verbose printing of the board
+
+         Times go into log-spaced bins (20 per decade, from 100 ns to 100 s), so memory does not grow with
+         the number of games and profilers of worker processes can be merged.  Percentiles are reported as
+         the upper edge of the bin they fall in.
+         """
+
+   PHASES = ('agent', 'validate', 'evaluate', 'output')
+   EDGES = list(np.logspace(-7, 2, 9*20+1))
+
+   def __init__(self):
+      self.histograms = {}
+      self.totals = {}
+      self.maxima = {}
+
+   def record(self, phase, guess, seconds, count=1):
+      """ Records count samples of the time of a phase
+
+            :param phase: name of the phase (one of PHASES)
+
+                   guess: index of the guess in the game, starting with 0
+
+                   seconds: the time of the phase
+
+                   count: number of samples with that time
+            """
+      key = (phase, guess)
+      histogram = self.histograms.get(key)
+      if histogram is None:
+         histogram = self.histograms[key] = [0] * (len(self.EDGES) + 1)
+         self.totals[key] = 0.0
+         self.maxima[key] = 0.0
+      histogram[bisect.bisect_left(self.EDGES, seconds)] += count
+      self.totals[key] += seconds * count
+      if seconds > self.maxima[key]:
+         self.maxima[key] = seconds
+
+   def merge(self, other):
+      """ Adds the samples of another profiler to this one """
+      for key, histogram in other.histograms.items():
+         if key not in self.histograms:
+            self.histograms[key] = [0] * (len(self.EDGES) + 1)
+            self.totals[key] = 0.0
+            self.maxima[key] = 0.0
+         self.histograms[key] = [a + b for a, b in zip(self.histograms[key], histogram)]
+         self.totals[key] += other.totals[key]
+         self.maxima[key] = max(self.maxima[key], other.maxima[key])
+
+   def summary(self, histogram, total, maximum):
+      """ Returns the count, mean, percentiles and max. of a histogram as a dictionary """
+      counts = np.array(histogram)
+      n = int(np.sum(counts))
+      upper = np.array(self.EDGES + [np.inf])
+      cumulative = np.cumsum(counts)
+      summary = {'count': n, 'mean': total / n if n > 0 else 0.0}
+      for q in (50, 95, 99):
+         summary['p%d' % q] = float(min(upper[np.searchsorted(cumulative, q / 100 * n)], maximum))
+      summary['max'] = maximum
+      return summary
+
+   def report(self):
+      """ Returns the machine-readable report of the recorded times
+
+            :return: a dictionary with, for each phase, a summary over all guesses ('all') and per guess index
+            """
+      report = {}
+      for phase in self.PHASES:
+         keys = sorted(key for key in self.histograms if key[0] == phase)
+         if len(keys) == 0:
+            continue
+         report[phase] = {'per_guess': {}}
+         for key in keys:
+            report[phase]['per_guess'][str(key[1])] = self.summary(self.histograms[key], self.totals[key], self.maxima[key])
+         histogram = np.sum([self.histograms[key] for key in keys], axis=0)
+         report[phase]['all'] = self.summary(histogram, sum(self.totals[key] for key in keys),
+                                             max(self.maxima[key] for key in keys))
+      return report
+
+   def save(self, path):
+      """ Saves the report as JSON """
+      with open(path, 'w') as f:
+         json.dump(self.report(), f, indent=2)
+
+
 class MastermindGame:
 
    def __init__(self,code_length=5,num_colours=3,verbose=False,tournament=False):
 
-      self.colours = ['B','R','G','Y','P','C']
       self.code_length = code_length
       self.verbose = verbose
       if tournament:
@@ -131,7 +270,21 @@ class MastermindGame:
       else:
          self.throwError = self.errorAndExit
 
-      self.colours = self.colours[:num_colours]
+      if num_colours > len(COLOURS):
+         self.throwError("Error! At most %d colours are supported (got %d)." % (len(COLOURS), num_colours))
+
+      # Boards are played as arrays of colour indices; colour characters are only used by agents and for display
+      self.colours = COLOURS[:num_colours]
+      self.colour_index = {c: i for i, c in enumerate(self.colours)}
+
+      # PlayProfiler recording the time of the phases of play, None when profiling is off
+      self.profiler = None
+
+      # Max. time in seconds of a call to AgentFunction (None for no limit), the number of calls that took
+      # longer, and whether such a call is an error
+      self.time_budget = None
+      self.budget_overruns = 0
+      self.strict_budget = False
 
       if self.verbose:
          print("Mastermind")
@@ -146,24 +299,84 @@ class MastermindGame:
       self.errorStr = errorStr
       return None
 
+   def encode_board(self, board):
+      """ Returns a board of colour characters as a uint8 array of colour indices (boards of indices are returned
+          as uint8 arrays)
+          """
+      board = np.asarray(board)
+      if board.dtype.kind in 'ui':
+         return board.astype(np.uint8)
+      return np.array([self.colour_index[c] for c in board.reshape(-1)], dtype=np.uint8).reshape(board.shape)
+
+   def encode_actions(self, player, actions):
+      """ Converts the guess(es) returned by an agent into colour indices
+
+            :param player: the player who made the guesses
+
+                   actions: a guess or an array of guesses, made of colour characters
+
+            :return: a uint8 array of colour indices of the same shape as actions, or None (after throwError in
+                     tournament mode) if actions contains an illegal character
+            """
+      actions = np.asarray(actions)
+      values, inverse = np.unique(actions, return_inverse=True)
+      try:
+         indices = np.array([self.colour_index[c] for c in values.tolist()], dtype=np.uint8)
+      except (KeyError, TypeError):
+         illegal = [c for c in values.tolist() if c not in self.colour_index]
+         return self.throwError(
+            "Error! AgentFunction from '%s.py' returned a list \n%s\n, which contains illegal character '%s' (legal characters are %s)."
+            % (player.playerFile, actions, illegal[0], self.colours))
+      return indices[inverse].reshape(actions.shape)
+
 
 
-   def play(self,player,target,num_guesses):
+   def play(self,player,target,num_guesses,guesses=None):
+      """ Plays a game
+
+            :param player: the player
+
+                   target: the target board, as a uint8 array of colour indices (or colour characters)
+
+                   num_guesses: max. number of guesses per game
+
+                   guesses: optional list to which the guesses are appended as uint8 arrays of colour indices
+
+            :return: the score of the game
+            """
+
+      target = self.encode_board(target)
+      target_counts = colour_counts(target, len(self.colours))
+      num_colours = len(self.colours)
 
       score = 0
       guess = 0
       actions = np.zeros(shape=(self.code_length)).astype('uint8')
       in_place = 0
       in_colour = 0
+      profiler = self.profiler
       while guess<num_guesses+1:
 
          percepts = (guess, actions, in_place, in_colour)
 
+         if profiler is not None or self.time_budget is not None:
+            t0 = time.perf_counter()
+
          try:
             actions = player.agent.AgentFunction(percepts)
          except Exception as e:
             self.throwError(str(e))
 
+         if profiler is not None or self.time_budget is not None:
+            t1 = time.perf_counter()
+            if profiler is not None:
+               profiler.record('agent', guess, t1 - t0)
+            if self.time_budget is not None and t1 - t0 > self.time_budget:
+               self.budget_overruns += 1
+               if self.strict_budget:
+                  self.throwError("Error! AgentFunction from '%s.py' took %.3f s, over the time budget of %.3f s per guess." % (
+                                  player.playerFile, t1 - t0, self.time_budget))
+
          try:
             if not isinstance(actions,list) and not isinstance(actions,np.ndarray):
                if actions == None:
@@ -180,19 +393,36 @@ class MastermindGame:
                   "Error! AgentFunction from '%s.py' did return a list with %d items (expecting %d items)." % (
                      player.playerFile, len(actions), self.code_length))
 
-            for j, a in enumerate(actions):
-               if a not in self.colours:
-                  self.throwError(
-                     "Error! AgentFunction from '%s.py' returned a list \n%s\n, which contains illegal character '%c' (legal characters are %s)."
-                     % (player.playerFile, actions, a, self.colours))
+         # Checking the characters of the guess and converting them to colour indices is a single dictionary
+         # lookup per position
+         try:
+            code = np.array([self.colour_index[a] for a in actions], dtype=np.uint8)
+         except (KeyError, TypeError):
+            code = self.encode_actions(player, actions)
+            if code is None:
+               score = num_guesses
+               break
+
+         if profiler is not None:
+            t2 = time.perf_counter()
+            profiler.record('validate', guess, t2 - t1)
+
+         if guesses is not None:
+            guesses.append(code)
 
-         in_place, in_colour = evaluate_guess(actions,target)
+         in_place, in_colour = unpack_feedback(int(feedback(code, target, num_colours, code_counts=target_counts)),
+                                               self.code_length)
+
+         if profiler is not None:
+            profiler.record('evaluate', guess, time.perf_counter() - t2)
 
 
          score += 1
          guess += 1
 
          if self.verbose:
+            if profiler is not None:
+               t3 = time.perf_counter()
 
             sys.stdout.write("Guess %2d:\r\n" % (guess))
 
@@ -209,7 +439,10 @@ class MastermindGame:
 
             sys.stdout.write("   ")
 
-         if in_place == np.prod(np.shape(target)):
+            if profiler is not None:
+               profiler.record('output', guess-1, time.perf_counter() - t3)
+
+         if in_place == self.code_length:
             if self.verbose:
                if score == 1:
                   print("Solved in 1 guess!")
@@ -225,12 +458,133 @@ class MastermindGame:
          print("The solution was: ")
          sys.stdout.write("   ")
          for c in target:
-            print_colour_char(c)
+            print_colour_char(self.colours[c])
          sys.stdout.write("\r\n")
       return score*2
 
+   def play_batch(self,player,targets,num_guesses,guesses=None):
+      """ Plays a batch of games in lockstep
+
+            All games still in play make their next guess together and all of the guesses are scored with a single
+            call to the feedback kernel.  Agents opt in by implementing
+
+               AgentFunctionBatch(percepts_batch)
+
+            where percepts_batch is a tuple of five arrays: game_ids, guess_counters, last_guesses, in_place and
+            in_colour, each with one row per game still in play (game_ids index into targets, so that an agent can
+            keep per-game state).  It returns one guess per row - a len(game_ids) x code_length array, or a list
+            whose items are guesses or None for giving up.  Agents that only implement AgentFunction are played
+            one game at a time with play.
+
+            Scores follow the same rules as play.
+
+            :param player: the player
+
+                   targets: num_games x code_length uint8 array of colour indices (or colour characters)
+
+                   num_guesses: max. number of guesses per game
+
+                   guesses: optional list of num_games lists, to which the guesses of each game are appended as
+                            uint8 arrays of colour indices
+
+            :return: a vector of scores, one per game
+            """
+
+      if not hasattr(player.agent, 'AgentFunctionBatch'):
+         return np.array([self.play(player, target=target, num_guesses=num_guesses,
+                                    guesses=guesses[i] if guesses is not None else None)
+                          for i, target in enumerate(targets)])
+
+      num_games = len(targets)
+      target_codes = self.encode_board(targets)
+
+      scores = np.zeros(num_games, dtype=int)
+      last_guesses = np.zeros(shape=(num_games, self.code_length)).astype('uint8')
+      in_place = np.zeros(num_games, dtype=int)
+      in_colour = np.zeros(num_games, dtype=int)
+      active = np.arange(num_games)
+
+      guess = 0
+      profiler = self.profiler
+      while len(active) > 0:
+
+         percepts_batch = (active, np.full(len(active), guess), last_guesses[active], in_place[active], in_colour[active])
+
+         if profiler is not None:
+            t0 = time.perf_counter()
+
+         try:
+            actions = player.agent.AgentFunctionBatch(percepts_batch)
+         except Exception as e:
+            self.throwError(str(e))
+
+         # Times of a batch are recorded as the time per game in the batch
+         if profiler is not None:
+            t1 = time.perf_counter()
+            profiler.record('agent', guess, (t1 - t0) / len(active), len(active))
+
+         if not isinstance(actions,list) and not isinstance(actions,np.ndarray):
+            self.throwError("Error! AgentFunctionBatch from '%s.py' returned a %s (expecting a list or a numpy array)" % (player.playerFile,type(actions)))
+
+         if len(actions) != len(active):
+            self.throwError("Error! AgentFunctionBatch from '%s.py' returned %d guesses (expecting %d guesses)." % (
+                            player.playerFile, len(actions), len(active)))
+
+         # Games given up by the agent score as if all guesses were used up
+         gave_up = np.array([a is None for a in actions], dtype=bool)
+         if np.any(gave_up):
+            scores[active[gave_up]] = num_guesses*2
+            actions = [a for a in actions if a is not None]
+            active = active[~gave_up]
+            if len(active) == 0:
+               break
+
+         actions = np.array(actions)
+         if actions.ndim != 2 or actions.shape[1] != self.code_length:
+            self.throwError(
+                  "Error! AgentFunctionBatch from '%s.py' did not return guesses with %d items." % (
+                     player.playerFile, self.code_length))
+
+
+         codes = self.encode_actions(player, actions)
+         if codes is None:
+            scores[active] = num_guesses*2
+            break
+
+         if profiler is not None:
+            t2 = time.perf_counter()
+            profiler.record('validate', guess, (t2 - t1) / len(active), len(active))
+
+         if last_guesses.dtype != actions.dtype:
+            last_guesses = last_guesses.astype(actions.dtype)
+         last_guesses[active] = actions
 
-   def run(self,agentFile='agent_human.py',num_guesses=6, num_games=1000,seed=None):
+         if guesses is not None:
+            for i, code in zip(active, codes):
+               guesses[i].append(code)
+
+         in_place[active], in_colour[active] = unpack_feedback(
+            feedback_pairs(codes, target_codes[active], len(self.colours)).astype(int), self.code_length)
+
+         if profiler is not None:
+            profiler.record('evaluate', guess, (time.perf_counter() - t2) / len(active), len(active))
+
+         scores[active] += 1
+         guess += 1
+
+         solved = in_place[active] == self.code_length
+         active = active[~solved]
+
+         if guess >= num_guesses:
+            scores[active] *= 2
+            break
+
+      return scores
+
+
+   def run(self,agentFile='agent_human.py',num_guesses=6, num_games=1000,seed=None,num_workers=1,batch_size=1,
+           profile_file=None,results_file=None,progress_interval=0,quiet=False,time_budget=None,strict_budget=False,
+           result_cache=False,threads=False):
 
       if self.verbose:
          print("Game play:")
@@ -240,41 +594,488 @@ class MastermindGame:
       if seed is None:
          seed = int(time.time())
 
-      rnd = np.random.RandomState(seed)
-
-      try:
-         player = Player(playerFile=agentFile,code_length=self.code_length,colours=list(self.colours),num_guesses=num_guesses)
-      except Exception as e:
-         self.throwError(str(e))
+      if profile_file is not None and self.profiler is None:
+         self.profiler = PlayProfiler()
+
+      self.time_budget = time_budget
+      self.strict_budget = strict_budget
+
+      if num_workers is None:
+         num_workers = os.cpu_count()
+
+      colours = list(self.colours)
+
+      # Results of the games already played by the same agent with the same settings and seed, if caching is on
+      cache = None
+      cached = {}
+      if result_cache:
+         cache = ResultCache(agentFile, self.cache_config(num_guesses, seed, batch_size, time_budget), colours,
+                             self.code_length, num_guesses)
+         cached = cache.load(num_games, lambda games: self.target_boards(seed, games))
+         if not quiet and len(cached) > 0:
+            print("Results of %d of %d games read from %s." % (len(cached), num_games, cache.path))
+
+      # Ranges of consecutive games left to play
+      ranges = []
+      first = 0
+      for game in sorted(cached):
+         if game > first:
+            ranges.append((first, game))
+         first = game + 1
+      if first < num_games:
+         ranges.append((first, num_games))
+
+      player = None
+      if num_workers <= 1 and len(ranges) > 0:
+         try:
+            player = Player(playerFile=agentFile,code_length=self.code_length,colours=list(self.colours),num_guesses=num_guesses,
+                            time_budget=time_budget)
+         except Exception as e:
+            self.throwError(str(e))
 
-      all_boards = (num_games, self.code_length)
+      sink = ResultSink(colours, self.code_length, num_guesses, path=results_file,
+                        progress_interval=progress_interval, quiet=quiet)
+      record = sink.recording or cache is not None
 
-      self.colours = np.array(self.colours)
+      if num_workers > 1:
+         played = self.run_parallel(agentFile, colours, num_guesses, seed, ranges, num_workers, batch_size, record,
+                                    threads)
+      else:
+         played = (result for first, end in ranges
+                   for result in self.play_range(player, seed, first, end, num_guesses, batch_size, record, num_games))
 
-      I = rnd.randint(0,len(self.colours),size=(all_boards))
+      results = itertools.chain(((game,) + cached[game] for game in sorted(cached)), played)
 
       score = 0
       game_count = 0
       tot_time = 0
-      for i in I:
+      start = time.time()
+      for game, game_score, seconds, guesses in results:
+         score += game_score
+         game_count += 1
+         tot_time += seconds
+
+         if sink.recording or cache is not None:
+            target = self.target_boards(seed, [game])[0]
+         if sink.recording:
+            sink.add(game, target, guesses, game_score, seconds)
+         if cache is not None and game not in cached:
+            cache.add(game, target, guesses, game_score, seconds)
+
+         # With a pool of workers the games overlap, so the expected running time comes from the wall-clock time
+         if num_workers > 1:
+            tot_time = time.time() - start
+
+         sink.progress(lambda: self.report_progress(score, game_count, num_games, tot_time), game_count, num_games)
+
+      sink.close()
+      if cache is not None:
+         cache.close()
+
+      if not quiet:
+         if player is not None:
+            self.report_agent_stats(player)
+         if time_budget is not None:
+            print("Agent took longer than the time budget of %.3f s in %d guesses." % (time_budget, self.budget_overruns))
+         if results_file is not None:
+            print("Game results saved to %s." % results_file)
+         self.save_profile(profile_file)
+      elif self.profiler is not None and profile_file is not None:
+         self.profiler.save(profile_file)
+
+      return score / num_games
+
+   def cache_config(self, num_guesses, seed, batch_size, time_budget):
+      """ Returns everything besides the agent file that the results of run depend on, as the key of the result cache
+          (see ResultCache) """
+      return {'code_length': self.code_length, 'colours': list(self.colours), 'num_guesses': num_guesses,
+              'seed': seed, 'batch_size': batch_size, 'time_budget': time_budget,
+              'settings': {key: value for key, value in game_settings.items() if key not in UNCACHED_SETTINGS}}
+
+   def target_boards(self, seed, games):
+      """ Returns the target boards of the given games of a run with the given seed (see target_boards)
+
+            :return: len(games) x code_length uint8 array of colour indices, one byte per position
+            """
+      return target_boards(seed, games, self.code_length, len(self.colours))
+
+   def run_tournament(self,agentFiles,num_guesses=6,num_games=1000,seed=None,num_workers=1,batch_size=1,quiet=False,
+                      time_budget=None,strict_budget=False,threads=False):
+      """ Plays several agents on the same target boards and ranks them by their average score
+
+            The boards are derived from the seed, exactly as in run, so each agent gets the same score it would
+            get in a run with the same seed.  With num_workers > 1 the games of all agents are played on one pool
+            of worker processes (see play_parallel).
+
+            :param agentFiles: list of agent file names
+
+                   num_guesses: max. number of guesses per game
+
+                   num_games: number of games each agent plays
+
+                   seed: seed of the target boards, None for a random seed
+
+                   num_workers: number of worker processes, None for one per CPU
+
+                   batch_size: number of games played in lockstep (see play_batch)
+
+                   quiet: if True, the leaderboard is not printed
+
+                   time_budget: max. time in seconds of a call to AgentFunction, None for no limit
+
+                   strict_budget: if True, a call over the time budget is an error
+
+                   threads: if True, the games are played on a pool of num_workers threads instead of processes
+
+            :return: the leaderboard, a list of dictionaries with the agent, its average score, the number of games it
+                     played, the time it spent playing them and the number of games per second, best agent first
+            """
+      if seed is None:
+         seed = int(time.time())
+
+      self.time_budget = time_budget
+      self.strict_budget = strict_budget
+
+      if num_workers is None:
+         num_workers = os.cpu_count()
+
+      colours = list(self.colours)
+
+      if self.verbose:
+         print("Tournament:")
+         print("  Agents:           %s" % ", ".join(agentFiles))
+         print("  Num guesses:      %d" % num_guesses)
+         print("  Num rounds:       %d" % num_games)
+
+      scores = {agentFile: 0 for agentFile in agentFiles}
+      games = {agentFile: 0 for agentFile in agentFiles}
+      seconds = {agentFile: 0.0 for agentFile in agentFiles}
+
+      if num_workers > 1:
+         results = self.play_parallel(agentFiles, colours, num_guesses, seed, [(0, num_games)], num_workers, batch_size,
+                                      threads=threads)
+      else:
+         results = self.play_agents(agentFiles, seed, num_games, num_guesses, batch_size)
+
+      for agentFile, (game, game_score, game_seconds, guesses) in results:
+         scores[agentFile] += game_score
+         games[agentFile] += 1
+         seconds[agentFile] += game_seconds
+
+      leaderboard = [{'agent': agentFile, 'average_score': scores[agentFile] / num_games, 'games': games[agentFile],
+                      'seconds': seconds[agentFile],
+                      'games_per_second': games[agentFile] / seconds[agentFile] if seconds[agentFile] > 0 else float('inf')}
+                     for agentFile in agentFiles]
+      leaderboard.sort(key=lambda entry: entry['average_score'])
+
+      if not quiet:
+         self.report_leaderboard(leaderboard)
+         if time_budget is not None:
+            print("Agents took longer than the time budget of %.3f s in %d guesses." % (time_budget, self.budget_overruns))
+
+      return leaderboard
+
+   def play_agents(self, agentFiles, seed, num_games, num_guesses, batch_size=1):
+      """ Plays each agent on all of the games of a run, one agent after the other
+
+            :return: a generator of (agent file, (game index, score, running time, guesses)) tuples
+            """
+      for agentFile in agentFiles:
+         try:
+            player = Player(playerFile=agentFile,code_length=self.code_length,colours=list(self.colours),
+                            num_guesses=num_guesses,time_budget=self.time_budget)
+         except Exception as e:
+            self.throwError(str(e))
+            continue
+         for result in self.play_range(player, seed, 0, num_games, num_guesses, batch_size):
+            yield agentFile, result
+
+   def play_range(self, player, seed, first_game, end_game, num_guesses, batch_size=1, record=False, num_games=None):
+      """ Plays the games first_game to end_game - 1 of a run with play_games, generating their target boards (see
+          target_boards) BOARD_CHUNK games at a time, so memory does not grow with the number of games
+
+            :return: a generator of (game index, score, running time, guesses) tuples (see play_games)
+            """
+      for first in range(first_game, end_game, BOARD_CHUNK):
+         end = min(first + BOARD_CHUNK, end_game)
+         yield from self.play_games(player, self.target_boards(seed, np.arange(first, end)), first, num_guesses,
+                                    batch_size, record, num_games)
+
+   def play_games(self, player, boards, first_game, num_guesses, batch_size=1, record=False, num_games=None):
+      """ Plays a sequence of games, one at a time with play or, for batch_size > 1, in batches with play_batch
+
+            :param player: the player
+
+                   boards: uint8 array of colour indices of the target boards, one row per game
+
+                   first_game: index of the first game in the run
+
+                   num_guesses: max. number of guesses per game
+
+                   batch_size: number of games played in lockstep
+
+                   record: if True, the guesses of each game are returned
+
+                   num_games: total number of games of the run, for verbose output
+
+            :return: a generator of (game index, score, running time, guesses) tuples, where guesses is a list of
+                     uint8 arrays of colour indices, or None if record is False
+            """
+      if batch_size > 1:
+         for b in range(0, len(boards), batch_size):
+            targets = boards[b:b+batch_size]
+            guesses = [[] for _ in targets] if record else None
+            start = time.time()
+            scores = self.play_batch(player,targets=targets,num_guesses=num_guesses,guesses=guesses)
+            seconds = (time.time() - start) / len(targets)
+            for i, game_score in enumerate(scores):
+               yield first_game+b+i, int(game_score), seconds, guesses[i] if record else None
+         return
+
+      for i, board in enumerate(boards):
          if self.verbose:
-            print("Round %d/%d" % (game_count+1,len(I)))
+            print("Round %d/%d" % (first_game+i+1,num_games if num_games is not None else len(boards)))
 
+         guesses = [] if record else None
          start = time.time()
-         score += self.play(player,target=self.colours[i],num_guesses=num_guesses)
+         game_score = self.play(player,target=board,num_guesses=num_guesses,guesses=guesses)
          end = time.time()
-         game_count += 1
-         print("Average score after game %d: %.2f" % (game_count,score/(game_count)))
-         tot_time += end - start
+         yield first_game+i, game_score, end - start, guesses
+
+   def run_parallel(self, agentFile, colours, num_guesses, seed, ranges, num_workers, batch_size=1, record=False,
+                    threads=False):
+      """ Plays the games of run on a pool of worker processes
+
+            The games are split into shards of consecutive games, whose target boards the workers derive from the
+            seed exactly as for a serial run, so the total score does not depend on the number of workers.  Each
+            worker loads its own Player (see _init_worker).
+
+            :param agentFile: name of the agent file
+
+                   colours: list of colour characters of the game
+
+                   num_guesses: max. number of guesses per game
+
+                   seed: seed of the run (see target_boards)
+
+                   ranges: list of (first game, end game) ranges of the games to play
+
+                   num_workers: number of worker processes
+
+                   batch_size: number of games each worker plays in lockstep (see play_batch)
+
+                   record: if True, the guesses of each game are returned
 
-         if game_count < num_games:
-            avg_time = tot_time / game_count
-            print("Average running time per game %s." % (time_to_str(avg_time)))
-            print("Time remaining %s." % (time_to_str(avg_time * (num_games-game_count))))
-            print("Expected total running time %s." % (time_to_str(avg_time * num_games)))
-         else:
-            print("Total running time %s." % (time_to_str(tot_time)))
+                   threads: if True, the games are played on a pool of threads instead of processes
 
+            :return: a generator of (game index, score, running time, guesses) tuples, in order of completion
+            """
+      for _, result in self.play_parallel([agentFile], colours, num_guesses, seed, ranges, num_workers, batch_size,
+                                          record, threads):
+         yield result
+
+   def play_parallel(self, agentFiles, colours, num_guesses, seed, ranges, num_workers, batch_size=1, record=False,
+                     threads=False):
+      """ Plays the games of one or more agents on a pool of worker processes, or of threads
+
+            The games are split into shards of at most BOARD_CHUNK consecutive games of one agent, given out to the
+            workers agent by agent in turn.  Workers only get the seed and the range of games of a shard, and derive the target boards
+            from them (see play_range).
+
+            Threads share the process, so they only pay off for agents that spend their time in code that releases
+            the GIL (such as large NumPy operations); each thread plays with its own game and agents (see
+            play_threaded).
+
+            :param agentFiles: list of agent file names
+
+                   colours: list of colour characters of the game
+
+                   num_guesses: max. number of guesses per game
+
+                   seed: seed of the run (see target_boards)
+
+                   ranges: list of (first game, end game) ranges of the games to play
+
+                   num_workers: number of worker processes
+
+                   batch_size: number of games each worker plays in lockstep (see play_batch)
+
+                   record: if True, the guesses of each game are returned
+
+                   threads: if True, the games are played on a pool of threads instead of processes
+
+            :return: a generator of (agent file, (game index, score, running time, guesses)) tuples, in order of
+                     completion
+            """
+
+      num_games = sum(end - first for first, end in ranges)
+      # At most BOARD_CHUNK games a shard, so the results a shard holds stay bounded however many games are played
+      shard_size = max(1, min(BOARD_CHUNK, int(np.ceil(num_games / (num_workers * 8)))))
+      shards = [(agentFile, i, min(i+shard_size, end)) for first, end in ranges for i in range(first, end, shard_size)
+                for agentFile in agentFiles]
+
+      if self.verbose:
+         print("  Num workers:      %d" % num_workers)
+
+      if threads:
+         yield from self.play_threaded(agentFiles, colours, num_guesses, seed, num_workers, batch_size, record, shards)
+         return
+
+      with multiprocessing.Pool(processes=num_workers, initializer=_init_worker,
+                                initargs=(agentFiles, self.code_length, colours, num_guesses, seed, batch_size,
+                                          self.profiler is not None, record, self.time_budget,
+                                          self.strict_budget)) as pool:
+         for agentFile, shard_results, shard_profiler, shard_overruns, error in pool.imap_unordered(_play_shard,
+                                                                                                    shards):
+            # An agent that fails to load in the workers is reported, as in a serial run
+            if error is not None:
+               self.throwError(error)
+               return
+            if shard_profiler is not None:
+               self.profiler.merge(shard_profiler)
+            self.budget_overruns += shard_overruns
+            for result in shard_results:
+               yield agentFile, result
+
+   def play_threaded(self, agentFiles, colours, num_guesses, seed, num_workers, batch_size, record, shards):
+      """ Plays shards of games (see play_parallel) on a pool of threads
+
+            Each thread takes a game and a set of players of its own from a queue for the time of a shard, as neither
+            agents nor the profiler of a game can be shared between threads.  The profilers of the games are merged
+            into this game's at the end.
+
+            :return: a generator of (agent file, (game index, score, running time, guesses)) tuples, in order of
+                     completion
+            """
+      workers = queue.Queue()
+      games = []
+      for _ in range(min(num_workers, len(shards))):
+         game = MastermindGame(code_length=self.code_length, num_colours=len(colours), verbose=False)
+         game.time_budget = self.time_budget
+         game.strict_budget = self.strict_budget
+         if self.profiler is not None:
+            game.profiler = PlayProfiler()
+         players = {agentFile: Player(playerFile=agentFile, code_length=self.code_length, colours=list(colours),
+                                      num_guesses=num_guesses, time_budget=self.time_budget)
+                    for agentFile in agentFiles}
+         games.append(game)
+         workers.put((game, players))
+
+      def play_shard(shard):
+         game, players = workers.get()
+         try:
+            agentFile, first_game, end_game = shard
+            overruns = game.budget_overruns
+            results = list(game.play_range(players[agentFile], seed, first_game, end_game, num_guesses, batch_size,
+                                           record))
+            return agentFile, results, game.budget_overruns - overruns
+         finally:
+            workers.put((game, players))
+
+      with ThreadPoolExecutor(max_workers=num_workers) as pool:
+         for future in as_completed([pool.submit(play_shard, shard) for shard in shards]):
+            agentFile, shard_results, shard_overruns = future.result()
+            self.budget_overruns += shard_overruns
+            for result in shard_results:
+               yield agentFile, result
+
+      if self.profiler is not None:
+         for game in games:
+            self.profiler.merge(game.profiler)
+
+   def save_profile(self, profile_file):
+      """ Saves the report of the profiler, if profiling is on and profile_file is not None """
+      if self.profiler is not None and profile_file is not None:
+         self.profiler.save(profile_file)
+         print("Timing report saved to %s." % profile_file)
+
+   def report_agent_stats(self, player):
+      """ Prints the statistics reported by the agent's stats method, if it has one
+
+            :param player: the player
+            """
+      if hasattr(player.agent, 'stats'):
+         for name, stats in player.agent.stats().items():
+            print("Agent %s: %s" % (name, ", ".join("%s %s" % (k, v) for k, v in stats.items())))
+
+   def report_leaderboard(self, leaderboard):
+      """ Prints the leaderboard of run_tournament
+
+            :param leaderboard: list of leaderboard entries, best agent first
+            """
+      print("%4s  %-24s %13s %8s %12s" % ("Rank", "Agent", "Average score", "Games", "Games/s"))
+      for rank, entry in enumerate(leaderboard):
+         print("%4d  %-24s %13.3f %8d %12.1f" % (rank+1, entry['agent'], entry['average_score'], entry['games'],
+                                                entry['games_per_second']))
+
+   def report_progress(self, score, game_count, num_games, tot_time):
+      """ Prints the average score and the expected running time after game_count games
+
+            :param score: total score so far
+
+                   game_count: number of games played so far
+
+                   num_games: total number of games
+
+                   tot_time: time spent playing the games so far
+            """
+      print("Average score after game %d: %.2f" % (game_count,score/(game_count)))
+
+      if game_count < num_games:
+         avg_time = tot_time / game_count
+         print("Average running time per game %s." % (time_to_str(avg_time)))
+         print("Time remaining %s." % (time_to_str(avg_time * (num_games-game_count))))
+         print("Expected total running time %s." % (time_to_str(avg_time * num_games)))
+      else:
+         print("Total running time %s." % (time_to_str(tot_time)))
+
+
+# Game, players (by agent file) and seed of a worker process of MastermindGame.play_parallel
+_worker_game = None
+_worker_players = {}
+_worker_seed = None
+_worker_num_guesses = None
+_worker_batch_size = 1
+_worker_record = False
+_worker_error = None
+
+def _init_worker(agentFiles, code_length, colours, num_guesses, seed, batch_size=1, profile=False, record=False,
+                 time_budget=None, strict_budget=False):
+   global _worker_game, _worker_players, _worker_seed, _worker_num_guesses, _worker_batch_size, _worker_record, \
+          _worker_error
+
+   _worker_game = MastermindGame(code_length=code_length, num_colours=len(colours), verbose=False)
+   # An error raised by the initializer would make the pool start new workers over and over, so it is kept and
+   # returned with the first shard instead
+   try:
+      _worker_players = {agentFile: Player(playerFile=agentFile, code_length=code_length, colours=list(colours),
+                                           num_guesses=num_guesses, time_budget=time_budget)
+                         for agentFile in agentFiles}
+   except Exception as e:
+      _worker_error = str(e)
+   _worker_seed = seed
+   _worker_game.time_budget = time_budget
+   _worker_game.strict_budget = strict_budget
+   _worker_num_guesses = num_guesses
+   _worker_batch_size = batch_size
+   _worker_record = record
+   if profile:
+      _worker_game.profiler = PlayProfiler()
+
+def _play_shard(shard):
+   # Each shard returns the times recorded and the time budget overruns while playing it, to be merged by the
+   # parent process, and the error of the worker's initializer, if any
+   if _worker_error is not None:
+      return shard[0], [], None, 0, _worker_error
+   if _worker_game.profiler is not None:
+      _worker_game.profiler = PlayProfiler()
+   _worker_game.budget_overruns = 0
+
+   agentFile, first_game, end_game = shard
+   results = list(_worker_game.play_range(_worker_players[agentFile], _worker_seed, first_game, end_game,
+                                          _worker_num_guesses, _worker_batch_size, _worker_record))
+
+   return agentFile, results, _worker_game.profiler, _worker_game.budget_overruns, None
 
 
 
@@ -284,10 +1085,29 @@ if __name__ == "__main__":
                          num_colours=game_settings['numberOfColours'],
                          verbose=game_settings['verbose'])
 
-   game.run(agentFile=game_settings['agentFile'],
+   if game_settings['tournamentAgents'] is not None:
+      game.run_tournament(agentFiles=game_settings['tournamentAgents'],
          num_guesses=game_settings['maxNumberOfGuesses'],
          num_games=game_settings['totalNumberOfGames'],
-         seed=game_settings['seed'])
-
-
-
+         seed=game_settings['seed'],
+         num_workers=game_settings['numWorkers'],
+         batch_size=game_settings['batchSize'],
+         quiet=game_settings['quiet'],
+         time_budget=game_settings['moveTimeBudget'],
+         strict_budget=game_settings['strictTimeBudget'],
+         threads=game_settings['useThreads'])
+   else:
+      game.run(agentFile=game_settings['agentFile'],
+            num_guesses=game_settings['maxNumberOfGuesses'],
+            num_games=game_settings['totalNumberOfGames'],
+            seed=game_settings['seed'],
+            num_workers=game_settings['numWorkers'],
+            batch_size=game_settings['batchSize'],
+            profile_file=game_settings['profileFile'],
+            results_file=game_settings['resultsFile'],
+            progress_interval=game_settings['progressInterval'],
+            quiet=game_settings['quiet'],
+            time_budget=game_settings['moveTimeBudget'],
+            strict_budget=game_settings['strictTimeBudget'],
+            result_cache=game_settings['resultCache'],
+            threads=game_settings['useThreads'])
@@ -2,11 +2,32 @@ __author__ = "Luke Webb"
 __organization__ = "COSC343/AIML402, University of Otago"
 __email__ = "weblu938@student.otago.ac.nz"
 
+import atexit
+import hashlib
+import json
+import os
 import random
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Tuple, Any
 
 import numpy as np
-from itertools import product
+
+from feedback import code_space, encode, codes_to_index, feedback, feedback_matrix, num_feedbacks, pack_feedback, \
+    unpack_feedback
+from settings import game_settings
+
+# Directory of the saved strategy books (see StrategyBook)
+BOOK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.strategy_cache')
+
+# Largest number of (guess, possibility) pairs scored by an exact minimax search; larger searches are sampled.
+MAX_EXACT_SCORES = 2**25
+
+# Pools of possible solutions after the first guess (see get_after_first_guess_list) and the second
+# guesses made for them (see get_second_guess), shared by all agents of the process.
+_after_first_guess = {}
+_second_guesses = {}
 
 
 def get_random_actions(self):
@@ -19,10 +40,13 @@ def get_random_actions(self):
 
 def get_initial_list(self):
     """
-        Generates and returns the list of all possible solutions as a list of tuples.
+        Returns the list of all possible solutions as an array of code indices (see self.space).
         This list is based on the initialized colour and code-length of the game.
+
+        The array is shared and read-only (the pool is only ever narrowed down into new arrays),
+        so starting a new game costs nothing.
     """
-    return self.true_list.copy()
+    return self.space.indices()
 
 
 def initial_guess(self):
@@ -49,72 +73,729 @@ def initial_guess(self):
     return guess
 
 
-def update_list(current_list, sequence, score_of_sequence=tuple()):
+def to_index(self, sequence):
+    """
+        Converts a sequence of colour characters into its code index.
+
+        :param sequence: a list or array of colour characters.
+        :return: The index of the code in self.space.
+    """
+    return int(codes_to_index(encode(sequence, self.colours), len(self.colours)))
+
+
+def to_colours(self, index):
+    """
+        Converts a code index into a list of colour characters, as returned to the game.
+
+        :param index: The index of the code.
+        :return: The code as a list of colour characters.
+    """
+    return [self.colours[c] for c in self.space.codes(index)]
+
+
+def replay_history(self, history):
+    """
+        Rebuilds the pool of possible solutions from the history of a game.
+
+        :param history: list of (guess index, packed score) of the guesses made so far.
+        :return: The array of indices of the possible solutions.
+    """
+    if len(history) > 0 and history[0][0] == self.first_guess:
+        possibles = get_after_first_guess(self, history[0][1])
+        history = history[1:]
+    else:
+        possibles = get_initial_list(self)
+    for guess, score in history:
+        possibles = update_list(self, possibles, guess, score)
+        possibles = possibles[possibles != guess]
+    return possibles
+
+
+def get_after_first_guess_list(self):
+    """
+        Partitions all possible solutions by their score against the first guess (see initial_guess).
+        Computed once per process for given settings and shared by all agents.
+
+        :return: A dictionary mapping each packed score to the array of indices of the possible
+                 solutions left after the first guess received that score.
+    """
+    key = (self.code_length, len(self.colours), self.first_guess)
+    if key not in _after_first_guess:
+        # The code space is scored in chunks, so that no array of the size of the space is needed
+        # beyond the partitions themselves.
+        first_guess = self.space.codes(self.first_guess)
+        parts = {}
+        for indices, codes in self.space.chunks():
+            scores = feedback(first_guess, codes, len(self.colours))
+            scores[indices == self.first_guess] = num_feedbacks(self.code_length)
+            order = np.argsort(scores, kind='stable')
+            bounds = np.searchsorted(scores[order], np.arange(num_feedbacks(self.code_length) + 1))
+            for score in range(num_feedbacks(self.code_length)):
+                if bounds[score + 1] > bounds[score]:
+                    parts.setdefault(score, []).append(indices[order[bounds[score]:bounds[score + 1]]])
+        _after_first_guess[key] = {score: np.concatenate(part) for score, part in sorted(parts.items())}
+    return _after_first_guess[key]
+
+
+def get_after_first_guess(self, score):
+    """
+        :param score: the packed score of the first guess.
+        :return: The array of indices of the possible solutions left after the first guess.
+    """
+    return self.after_first_guess_list.get(int(score), self.space.indices()[:0])
+
+
+def get_second_guess(self, score):
+    """
+        The second guess for a given score of the first guess, memoized per process for given
+        settings and strategy.
+
+        :param score: the packed score of the first guess.
+        :return: The index of the second guess.
+    """
+    key = (self.code_length, len(self.colours), self.strategy, int(score))
+    if key in _second_guesses:
+        return _second_guesses[key]
+
+    guess = get_best_guess(self, get_after_first_guess(self, score))
+    if self.search_complete:
+        _second_guesses[key] = guess
+    return guess
+
+
+def book_path(self):
+    """
+        The file of the strategy book for the agent's settings and strategy.
+    """
+    return os.path.join(BOOK_DIR, "book_%dx%d_%s.json" % (self.code_length, len(self.colours), self.strategy))
+
+
+def update_list(self, current_list, sequence, score_of_sequence=tuple()):
     """
         Used to update the current list of possible guesses based on the last guess.
-        Iterates over all guesses in the current_list and compares them to the input
-        sequence as if it were the solution.
+        Compares all guesses in the current_list to the input sequence as if it were the solution,
+        in a single vectorised comparison.
 
-        :param  current_list: the current list of possibilities in this state of the game.
+        :param  current_list: the current array of indices of possibilities in this state of the game.
 
-                sequence: the previous guess.
+                sequence: index of the previous guess.
 
-                score_of_sequence: a tuple containing the evaluation of the last guess as (in_place, in_colour).
+                score_of_sequence: a tuple containing the evaluation of the last guess as (in_place, in_colour),
+                                   or the packed evaluation.
 
-        :return: The updated list, with all impossible guesses removed from the list of possibilities.
+        :return: The updated array, with all impossible guesses removed from the array of possibilities.
     """
-    new_set = set()
-    for guess in current_list:
-        if evaluate_guess(guess, sequence) != score_of_sequence:
-            new_set.add(guess)
-    return list(set.difference(set(current_list), new_set))
+    if isinstance(score_of_sequence, tuple):
+        score_of_sequence = pack_feedback(score_of_sequence[0], score_of_sequence[1], self.code_length)
+    scores = get_scores(self, [sequence], current_list)[0]
+    return current_list[scores == score_of_sequence]
 
 
-def get_best_guess(current_list):
+def get_scores(self, guess_list, current_list):
     """
-        Helper function that allows the user to choose which implementation of minimax to use
-        when finding the next best guess.
+        Scores every guess in guess_list against every item in current_list.
 
-        Final implementation uses the minimax_lazy function.
+        When the feedback matrix is available this is a lookup of the rows of guess_list
+        and the columns of current_list, otherwise the scores are computed with the feedback kernel.
 
-        :param current_list: The current list, of which the guess will be taken from.
-        :return: The next best guess.
+        :param guess_list: array of indices of the guesses.
+                current_list: array of indices of the items scored against.
+
+        :return: A len(guess_list) x len(current_list) array of packed (in_place, in_colour) scores.
     """
-    # Uncomment the following line for more accurate, but very slow minimax.
-    # return (minimax_full(current_list)
+    if self.feedback_matrix is not None:
+        # The score does not depend on which of the two codes is the guess, so the matrix is symmetric and
+        # the (contiguous) rows of whichever list is shorter can be gathered.
+        if len(guess_list) <= len(current_list):
+            return self.feedback_matrix[guess_list][:, current_list]
+        return self.feedback_matrix[current_list][:, guess_list].T
 
-    # Quicker mini-max function, Final implementation
-    return minimax_lazy(current_list)
+    return feedback(self.space.codes(guess_list), self.space.codes(current_list), len(self.colours),
+                    self.space.counts(guess_list), self.space.counts(current_list)).reshape(len(guess_list),
+                                                                                          len(current_list))
 
 
-def minimax_full(current_list):
+def get_best_guess(self, current_list):
+    """
+        Helper function that picks the implementation of minimax to use when finding the next best guess,
+        according to the strategy chosen in settings (see STRATEGIES).
+
+        Final implementation uses the exact minimax_full function, or minimax_sampled when the pool of
+        possibilities is larger than self.sample_threshold or the exact search would have to score more
+        than MAX_EXACT_SCORES pairs of codes. Both rank the guesses with the scorer of the strategy.
+        With lookahead on, the exact search is followed by minimax_lookahead.
+
+        :param current_list: The current array of possibilities, of which the guess will be taken from.
+        :return: The index of the next best guess.
+    """
+    # The quicker, heuristic minimax.
+    if self.scorer is None:
+        return minimax_lazy(self, current_list)
+
+    # Sampled mini-max function for large pools of possibilities
+    num_guesses = self.space.size if self.full_space_guesses else len(current_list)
+    if len(current_list) > self.sample_threshold or num_guesses * len(current_list) > MAX_EXACT_SCORES:
+        return minimax_sampled(self, current_list, self.full_space_guesses, self.deadline)
+
+    # Two-ply search over the best guesses of the exact mini-max, if enabled in settings
+    if self.lookahead:
+        return minimax_lookahead(self, current_list, self.full_space_guesses, self.deadline)
+
+    # Exact mini-max function, Final implementation
+    return minimax_full(self, current_list, self.full_space_guesses, self.deadline)
+
+
+def partition_sizes(self, guess_list, current_list):
+    """
+        Counts, for every guess, how many items of current_list fall into each possible score,
+        i.e. the sizes of the partitions of current_list that each guess induces.
+
+        All histograms are computed with a single np.bincount, by offsetting the packed scores
+        of guess i by i * num_feedbacks.
+
+        :param guess_list: array of indices of the guesses.
+                current_list: array of indices of the current possibilities.
+
+        :return: A len(guess_list) x num_feedbacks array of partition sizes.
+    """
+    num_scores = num_feedbacks(self.code_length)
+    scores = get_scores(self, guess_list, current_list) + np.arange(len(guess_list), dtype=np.intp)[:, None] * num_scores
+    return np.bincount(scores.ravel(order='K'), minlength=len(guess_list) * num_scores).reshape(len(guess_list),
+                                                                                                num_scores)
+
+
+# Scorers of guesses: each maps the partition sizes of a block of guesses (see partition_sizes) to one value
+# per guess, the lower the better.
+
+def worst_case_score(sizes):
+    """
+        Knuth's criterion, the size of the largest partition.
+    """
+    return sizes.max(axis=1)
+
+
+def expected_size_score(sizes):
+    """
+        The expected size of the partition the solution falls into, times the size of the pool
+        (the same for all guesses), which keeps the score an integer.
+    """
+    return (sizes * sizes).sum(axis=1)
+
+
+def entropy_score(sizes):
+    """
+        The information gained by the guess, negated. As the size n of the pool is the same for all
+        guesses, log2(n) - entropy = sum(n_i * log2(n_i)) / n, and the sum is used. It is rounded so that
+        guesses with the same partition sizes in a different order tie.
+    """
+    sizes = sizes.astype(np.float64)
+    return np.round((sizes * np.log2(np.maximum(sizes, 1))).sum(axis=1), 9)
+
+
+def most_parts_score(sizes):
+    """
+        The number of non-empty partitions, negated.
+    """
+    return -np.count_nonzero(sizes, axis=1)
+
+
+# Strategies selectable with the 'strategy' setting, mapped to their scorers; 'lazy' is the heuristic
+# minimax_lazy, which does not score partitions.
+STRATEGIES = {'worst_case': worst_case_score,
+              'expected_size': expected_size_score,
+              'entropy': entropy_score,
+              'most_parts': most_parts_score,
+              'lazy': None}
+
+
+def minimax_full(self, current_list, full_space=False, deadline=None):
     """
         Implementation of the mini-max algorithm from Knuth 1977, from Wikipedia:
         <link>https://en.wikipedia.org/wiki/Mastermind_(board_game)</link>
 
-        Uses the robust evaluation when comparing each guess to the other in the input list.
+        Picks the guess whose partitions of the current list (see partition_sizes) get the lowest score
+        from the scorer of the strategy; with the worst_case scorer, the guess whose largest partition is
+        the smallest. Ties are broken in favour of guesses that are still possible solutions, and then the lowest index.
+        Guesses that are symmetric to a guess with a lower index are skipped (see reduce_guesses).
 
-        Not used in final implementation, unless the user modifies the get_best_guess function above.
+        The search is anytime: guesses are evaluated in order of how promising they are (see order_guesses),
+        and if the deadline passes the best guess evaluated so far is returned and self.search_complete
+        is set to False.
 
-        :param current_list: The current list at this point in the game.
-        :return: The next best guess to narrow down the current list.
+        :param current_list: The current array of possibilities at this point in the game.
+                full_space: if True, codes that are no longer possible are also considered as guesses.
+                deadline: optional time.perf_counter() value at which the search stops.
+        :return: The index of the next best guess to narrow down the current list.
     """
-    score_occurrences = {}
-    for guess in current_list:
-        guess_score_occurrence = {}
-        for sub_guess in current_list:
-            score = evaluate_guess(sub_guess, guess)
-            if score in guess_score_occurrence:
-                guess_score_occurrence[score] += 1
-            else:
-                guess_score_occurrence[score] = 1
-        guess_min_score_frequency = min(guess_score_occurrence.items(), key=lambda x: x[0])[1]
-        score_occurrences[guess] = guess_min_score_frequency
-    min_score = max(score_occurrences, key=lambda x: x[1])
-    return min_score
+    if len(current_list) <= 2:
+        return current_list[0]
+
+    guess_list, is_possible = candidate_guesses(self, current_list, full_space, deadline)
+    scores = guess_scores(self, guess_list, current_list, deadline)
+    evaluated = len(scores)
+
+    return select_best(guess_list[:evaluated], scores, is_possible[:evaluated])
+
+
+def minimax_lookahead(self, current_list, full_space=False, deadline=None):
+    """
+        Two-ply version of minimax_full, which picks the guess expected to solve the game in the fewest
+        guesses rather than the guess with the best partition.
+
+        The guesses are ranked as in minimax_full, and the best self.lookahead_width of them are searched
+        one move deeper: each part of the partition of current_list they induce costs the expected number
+        of guesses left after its best follow-up guess (see follow_up_cost), and the guess with the lowest
+        expected total,
+            1 + sum over the parts of |part| / |current_list| * follow_up_cost(part),
+        is picked, ties going to the better ranked guess. The part of the guess itself costs nothing.
+
+        The deeper search stops self.lookahead_cap seconds after it started, or at the deadline, with the
+        best guess searched so far (the best guess of minimax_full if none was), and self.search_complete
+        is then set to False. The time is checked between the parts and within follow_up_cost, and a guess
+        whose search was cut short is left out.
+
+        :param current_list: The current array of possibilities at this point in the game.
+                full_space: if True, codes that are no longer possible are also considered as guesses.
+                deadline: optional time.perf_counter() value at which the search stops.
+        :return: The index of the next best guess to narrow down the current list.
+    """
+    if len(current_list) <= 2:
+        return current_list[0]
+
+    shortlist = ranked_guesses(self, current_list, self.lookahead_width, full_space, deadline)
+
+    cap = time.perf_counter() + self.lookahead_cap
+    if deadline is not None:
+        cap = min(cap, deadline)
+    solved = pack_feedback(self.code_length, 0, self.code_length)
+    self.lookahead_searches += 1
+
+    expected = []
+    for guess in shortlist:
+        # Parts of the partition, each sorted like current_list
+        part_scores = get_scores(self, [guess], current_list)[0]
+        order = np.argsort(part_scores, kind='stable')
+        bounds = np.flatnonzero(np.diff(part_scores[order])) + 1
+        total = 0.0
+        cut_short = False
+        for part, score in zip(np.split(current_list[order], bounds), part_scores[order][np.r_[0, bounds]]):
+            if score == solved:
+                continue
+            cost = follow_up_cost(self, part, full_space, cap) if time.perf_counter() <= cap else None
+            if cost is None:
+                cut_short = True
+                break
+            total += len(part) * cost
+
+        if cut_short:
+            # The guess is left out, as its expected total is only partly known
+            self.search_complete = False
+            self.lookahead_cutoffs += 1
+            break
+        expected.append(1 + total / len(current_list))
+
+    if len(expected) == 0:
+        return shortlist[0]
+    return shortlist[np.argmin(np.round(expected, 9))]
+
+
+def ranked_guesses(self, current_list, width, full_space=False, deadline=None):
+    """
+        The best guesses of minimax_full, best first.
+
+        :param current_list: The current array of possibilities.
+                width: the number of guesses returned, at most.
+                full_space: if True, codes that are no longer possible are also considered as guesses.
+                deadline: optional time.perf_counter() value at which the search stops.
+        :return: The array of indices of the guesses, in the order of select_best; pruned guesses are left out.
+    """
+    guess_list, is_possible = candidate_guesses(self, current_list, full_space, deadline)
+    scores = guess_scores(self, guess_list, current_list, deadline, keep=width)
+    evaluated = len(scores)
+    guess_list, is_possible = guess_list[:evaluated], is_possible[:evaluated]
+
+    ranking = np.lexsort((guess_list, ~is_possible, scores))[:width]
+    return guess_list[ranking[np.isfinite(scores[ranking])]]
+
+
+def follow_up_cost(self, current_list, full_space=False, cap=None):
+    """
+        The expected number of guesses needed to solve a pool of possibilities with its best guess, where the
+        pools left by that guess are counted at the fewest guesses they can take: a pool of m possibilities
+        takes one more guess if the guess is the solution, and at least two otherwise, (2m - 1) / m on average.
+
+        For a pool of n possibilities and a guess that splits it into k parts besides its own part, with s = 1
+        if the guess is a possible solution and 0 if not, this is
+            1 + (2 (n - s) - k) / n
+        so the best guess is the one with the most parts, counting a possible solution twice. The search stops
+        early if a guess leaves no part with more than one possibility.
+
+        The costs are memoized by the hash of the pool in self.subtree_cache, so each pool is searched once
+        however many games or guesses lead to it.
+
+        :param current_list: The array of possibilities, sorted.
+                full_space: if True, codes that are no longer possible are also considered as guesses.
+                cap: optional time.perf_counter() value at which the search stops.
+        :return: The expected number of guesses, or None if the search reached cap first (nothing is memoized).
+    """
+    n = len(current_list)
+    if n <= 2:
+        return (2 * n - 1) / n
+
+    key = self.subtree_cache.key(current_list)
+    cost = self.subtree_cache.get(key)
+    if cost is not None:
+        return cost
+
+    solved = pack_feedback(self.code_length, 0, self.code_length)
+    guess_list, _ = order_guesses(self, current_list, full_space)
+    # Smaller blocks under a cap, so that it is checked often enough
+    block_size = max(1, (2**22 if cap is None else 2**19) // n)
+    best = 0
+    for start in range(0, len(guess_list), block_size):
+        if cap is not None and time.perf_counter() > cap:
+            return None
+        sizes = partition_sizes(self, guess_list[start:start + block_size], current_list)
+        # 2 s + k, as the part of a possible guess is its own and has one possibility
+        best = max(best, int((sizes[:, solved] + np.count_nonzero(sizes, axis=1)).max()))
+        if best == n + 1:
+            break
+
+    cost = 1 + (2 * n - best) / n
+    self.subtree_cache.put(key, cost)
+    return cost
+
+
+def minimax_sampled(self, current_list, full_space=False, deadline=None):
+    """
+        Monte Carlo version of minimax_full for pools of possibilities too large for an exact search.
+
+        The partition sizes are estimated on a random sample of at most self.sample_size possibilities,
+        and only self.sample_probes guesses are evaluated: possible solutions drawn from the pool and,
+        if full_space is True, half of them random codes from the whole code space. Larger samples
+        trade speed for accuracy.
+
+        The random draws are seeded from the pool itself, so the same pool always gives the same guess.
+
+        :param current_list: The current array of possibilities at this point in the game.
+                full_space: if True, codes that are no longer possible are also considered as guesses.
+                deadline: optional time.perf_counter() value at which the search stops.
+        :return: The index of the next best guess to narrow down the current list.
+    """
+    rng = np.random.default_rng([len(current_list), int(current_list[0]), int(current_list[-1])])
+
+    sample = current_list
+    if len(current_list) > self.sample_size:
+        sample = np.sort(rng.choice(current_list, size=self.sample_size, replace=False))
+
+    num_possible = min(len(current_list), self.sample_probes // 2 if full_space else self.sample_probes)
+    guess_list = np.sort(rng.choice(current_list, size=num_possible, replace=False))
+    if full_space:
+        others = np.unique(rng.integers(0, self.space.size, size=self.sample_probes - num_possible))
+        others = others[~np.isin(others, current_list, assume_unique=True)]
+        guess_list = np.concatenate((guess_list, others.astype(guess_list.dtype)))
+    is_possible = np.zeros(len(guess_list), dtype=bool)
+    is_possible[:num_possible] = True
+
+    scores = guess_scores(self, guess_list, sample, deadline)
+    evaluated = len(scores)
 
+    return select_best(guess_list[:evaluated], scores, is_possible[:evaluated])
 
-def minimax_lazy(current_list):
+
+def guess_scores(self, guess_list, current_list, deadline=None, keep=1):
+    """
+        Scores each guess with the scorer of the strategy (see STRATEGIES) applied to the partitions of
+        current_list, in blocks of guesses sized so that a block of scores has about 4M entries (1M when
+        there is a deadline to check).
+
+        With pruning on (self.prune), the keep-th best score found so far is kept as a bound, and guesses
+        that are shown not to be able to beat it are dropped part way (see pruned_scores), so that the scores
+        of the best keep guesses are exact. The first block is kept small, so that a bound is known early on.
+
+        With a deadline, the first block is kept small too, and the later blocks are cut down to the number
+        of guesses that can still be scored before the deadline at the rate of the blocks so far, so that
+        the deadline is not overrun by a whole block.
+
+        :param guess_list: array of indices of the guesses, in the order they are evaluated.
+                current_list: array of indices of the possibilities.
+                deadline: optional time.perf_counter() value at which the evaluation stops; if it does,
+                          self.search_complete is set to False.
+                keep: the number of best guesses whose scores must not be pruned.
+        :return: The scores of the guesses evaluated before the deadline, i.e. of a prefix of guess_list.
+                 Pruned guesses score infinity.
+    """
+    block_size = max(1, (2**22 if deadline is None else 2**20) // len(current_list))
+    bound = np.inf
+    best = np.zeros(0)
+    scores = []
+    start = 0
+    began = time.perf_counter()
+    while start < len(guess_list):
+        size = min(block_size, 64) if (self.prune or deadline is not None) and start == 0 else block_size
+        if deadline is not None and start == 0 and began > deadline:
+            # Out of time before the search began: the first guess is played
+            size = 1
+            self.search_complete = False
+        elif deadline is not None and start > 0:
+            now = time.perf_counter()
+            size = min(size, int((deadline - now) * start / max(now - began, 1e-9)))
+            if size < 1:
+                self.search_complete = False
+                break
+        block = guess_list[start:start + size]
+        self.pairs_total += len(block) * len(current_list)
+        if self.prune:
+            scores.append(pruned_scores(self, block, current_list, bound))
+            best = np.sort(np.concatenate((best, scores[-1])))[:keep]
+            if len(best) == keep:
+                bound = best[-1]
+        else:
+            self.pairs_scored += len(block) * len(current_list)
+            scores.append(self.scorer(partition_sizes(self, block, current_list)))
+        start += size
+    return np.concatenate(scores)
+
+
+def pruned_scores(self, guess_list, current_list, bound):
+    """
+        Scores guesses like guess_scores, but goes through current_list in a few chunks, and after each
+        chunk drops the guesses whose score is already certain to be above bound: the partition sizes only
+        grow as more possibilities are scored, and so do all of the scores but most_parts, which can drop
+        by at most one per possibility left. A guess scoring bound itself is kept, as it may still win a tie.
+
+        :param guess_list: array of indices of the guesses.
+                current_list: array of indices of the possibilities.
+                bound: the best score found so far.
+        :return: The scores of the guesses, infinity for the guesses dropped.
+    """
+    sizes = np.zeros((len(guess_list), num_feedbacks(self.code_length)), dtype=np.int64)
+    alive = np.arange(len(guess_list))
+    remaining = len(current_list)
+    for chunk in np.array_split(current_list, max(1, min(8, len(current_list) // 32))):
+        sizes[alive] += partition_sizes(self, guess_list[alive], chunk)
+        self.pairs_scored += len(alive) * len(chunk)
+        remaining -= len(chunk)
+        if remaining > 0 and bound < np.inf:
+            lower = self.scorer(sizes[alive])
+            if self.scorer is most_parts_score:
+                lower = lower - remaining
+            alive = alive[lower <= bound]
+
+    scores = np.full(len(guess_list), np.inf)
+    scores[alive] = self.scorer(sizes[alive])
+    return scores
+
+
+def candidate_guesses(self, current_list, full_space=False, deadline=None):
+    """
+        The guesses of the minimax search in the order they are evaluated (see order_guesses), less the
+        guesses symmetric to others (see reduce_guesses).
+
+        Both steps go over the whole code space, so the deadline is checked first: if it has already passed,
+        only the possible solutions are considered as guesses and self.search_complete is set to False. The
+        reduction is given up if it takes more than half of the time left.
+
+        :param current_list: The current array of possibilities.
+                full_space: if True, codes that are no longer possible are also considered as guesses.
+                deadline: optional time.perf_counter() value at which the search stops.
+        :return: The array of indices of the guesses, and a boolean array telling which of them are possible
+                 solutions.
+    """
+    if full_space and deadline is not None and time.perf_counter() > deadline:
+        full_space = False
+        self.search_complete = False
+
+    guess_list, is_possible = order_guesses(self, current_list, full_space)
+    # Finding the symmetric guesses costs about as much as scoring them against a small pool, and it may
+    # take at most half of the time left.
+    if self.use_symmetry and len(current_list) > self.code_length * len(self.colours):
+        symmetry_deadline = None
+        if deadline is not None:
+            symmetry_deadline = (time.perf_counter() + deadline) / 2
+        guess_list, is_possible = reduce_guesses(self, guess_list, is_possible, current_list, symmetry_deadline)
+    return guess_list, is_possible
+
+
+def order_guesses(self, current_list, full_space=False):
+    """
+        The guesses considered by the minimax search, in the order they are evaluated: the possible
+        solutions first (one of them may be the solution, and they win ties), then, if full_space is True,
+        the other codes, those with more distinct colours first, as they tend to split the possibilities
+        into more parts. The order of the code space is computed once (see CodeSpace.by_distinct_colours).
+
+        :param current_list: The current array of possibilities.
+                full_space: if True, codes that are no longer possible are also considered as guesses.
+        :return: The array of indices of the guesses, and a boolean array telling which of them are possible
+                 solutions.
+    """
+    if not full_space:
+        return current_list, np.ones(len(current_list), dtype=bool)
+
+    possible = np.zeros(self.space.size, dtype=bool)
+    possible[current_list] = True
+    ordered = self.space.by_distinct_colours()
+    others = ordered[~possible[ordered]]
+
+    guess_list = np.concatenate((current_list, others))
+    is_possible = np.zeros(len(guess_list), dtype=bool)
+    is_possible[:len(current_list)] = True
+    return guess_list, is_possible
+
+
+def find_symmetries(self, current_list):
+    """
+        Finds the permutations of colours and of positions under which the game so far looks the same.
+
+        Colours not used by any guess of the game so far (see self.history) are interchangeable, and so
+        are positions that held the same colour in every guess. Since swapping them changes neither the
+        guesses nor their scores, the possibilities are mapped onto themselves, and two guesses that are
+        swapped into each other split the possibilities into parts of the same sizes.
+
+        Each swap is checked against current_list, so that pools that do not come from the history of
+        the game (e.g. in benchmark.py) are not reduced wrongly.
+
+        :param current_list: The current array of possibilities.
+        :return: A tuple (colour_blocks, position_blocks) of lists of arrays of interchangeable colours and
+                 of interchangeable positions, or None if there is nothing to swap.
+    """
+    num_colours = len(self.colours)
+    if len(self.history) > 0:
+        guesses = self.space.codes(np.array([guess for guess, _ in self.history]))
+    else:
+        guesses = np.zeros((0, self.code_length), dtype=np.uint8)
+
+    unused = np.setdiff1d(np.arange(num_colours), guesses)
+    colour_blocks = [unused] if len(unused) > 1 else []
+
+    # Positions are grouped by their column of colours in the guesses so far
+    _, position_labels = np.unique(guesses.T, axis=0, return_inverse=True)
+    position_labels = np.reshape(position_labels, -1)
+    position_blocks = [np.flatnonzero(position_labels == label) for label in np.unique(position_labels)]
+    position_blocks = [block for block in position_blocks if len(block) > 1]
+
+    if len(colour_blocks) == 0 and len(position_blocks) == 0:
+        return None
+
+    # Adjacent swaps within each block generate all of the permutations of the block
+    codes = self.space.codes(current_list)
+    expected = np.sort(current_list)
+    for block in colour_blocks:
+        for a, b in zip(block[:-1], block[1:]):
+            swap = np.arange(num_colours, dtype=np.uint8)
+            swap[[a, b]] = swap[[b, a]]
+            if not np.array_equal(np.sort(self.space.index(swap[codes])), expected):
+                return None
+    for block in position_blocks:
+        for i, j in zip(block[:-1], block[1:]):
+            swap = np.arange(self.code_length)
+            swap[[i, j]] = swap[[j, i]]
+            if not np.array_equal(np.sort(self.space.index(codes[:, swap])), expected):
+                return None
+
+    return colour_blocks, position_blocks
+
+
+def orbit_keys(self, guess_list, colour_blocks, position_blocks, deadline=None):
+    """
+        Computes a key of each guess that is the same for two guesses if and only if a permutation of
+        the interchangeable colours and positions (see find_symmetries) maps one onto the other.
+
+        The key is made of the number of times each colour occurs in each group of positions (single
+        positions outside of position_blocks forming groups of their own), where the counts of the
+        interchangeable colours are sorted, as those colours can be relabelled.
+
+        :param guess_list: array of indices of the guesses.
+                colour_blocks: list of arrays of interchangeable colours.
+                position_blocks: list of arrays of interchangeable positions.
+                deadline: optional time.perf_counter() value at which the computation is given up.
+        :return: A len(guess_list) x num_key_columns integer array, or None if the deadline passed.
+    """
+    num_colours = len(self.colours)
+    in_block = np.zeros(self.code_length, dtype=bool)
+    for block in position_blocks:
+        in_block[block] = True
+    groups = list(position_blocks) + [np.array([i]) for i in np.flatnonzero(~in_block)]
+
+    interchangeable = np.zeros(num_colours, dtype=bool)
+    for block in colour_blocks:
+        interchangeable[block] = True
+    fixed = np.flatnonzero(~interchangeable)
+
+    # Counts of a colour over the groups of positions as a single integer
+    weights = (self.code_length + 1) ** np.arange(len(groups), dtype=np.int64)
+
+    # Smaller chunks with a deadline, so that it is checked often
+    chunk_size = 2**16 if deadline is None else 2**12
+    keys = []
+    for start in range(0, len(guess_list), chunk_size):
+        if deadline is not None and time.perf_counter() > deadline:
+            return None
+        codes = self.space.codes(guess_list[start:start + chunk_size])
+        one_hot = codes[:, :, None] == np.arange(num_colours, dtype=np.uint8)
+        counts = np.stack([one_hot[:, group].sum(axis=1) for group in groups], axis=1)
+        columns = [counts[:, :, fixed].reshape(len(codes), -1)]
+        for block in colour_blocks:
+            columns.append(np.sort(np.tensordot(counts[:, :, block], weights, axes=([1], [0])), axis=1))
+        keys.append(np.concatenate(columns, axis=1))
+    return np.concatenate(keys)
+
+
+def reduce_guesses(self, guess_list, is_possible, current_list, deadline=None):
+    """
+        Keeps one guess of each set of guesses that are symmetric given the history of the game (see
+        find_symmetries): the one with the lowest index. Symmetric guesses have the same partition sizes and
+        are all possible solutions or all not, so select_best picks the same guess from what is left.
+
+        Nothing is dropped if the deadline passes first.
+
+        :param guess_list: array of indices of the guesses, in the order they are evaluated.
+                is_possible: boolean array telling which guesses are possible solutions.
+                current_list: The current array of possibilities.
+                deadline: optional time.perf_counter() value at which the reduction is given up.
+        :return: The guesses left and the matching part of is_possible, in the same order.
+    """
+    self.symmetry_searches += 1
+    self.symmetry_guesses += len(guess_list)
+    symmetries = None
+    if deadline is None or time.perf_counter() <= deadline:
+        symmetries = find_symmetries(self, current_list)
+    keys = None
+    if symmetries is not None:
+        order = np.argsort(guess_list, kind='stable')
+        keys = orbit_keys(self, guess_list[order], *symmetries, deadline=deadline)
+    if keys is None:
+        self.symmetry_evaluated += len(guess_list)
+        return guess_list, is_possible
+
+    # Rows of keys are packed into single integers when they fit, as sorting rows is much slower
+    radices = keys.max(axis=0).astype(np.int64) + 1
+    if np.sum(np.log2(radices)) < 62:
+        keys = keys @ np.concatenate(([1], np.cumprod(radices[:-1])))
+    _, first = np.unique(keys, axis=0, return_index=True)
+    keep = np.zeros(len(guess_list), dtype=bool)
+    keep[order[first]] = True
+    self.symmetry_evaluated += int(np.count_nonzero(keep))
+    return guess_list[keep], is_possible[keep]
+
+
+def select_best(guess_list, scores, is_possible):
+    """
+        Picks the guess with the lowest score, preferring possible solutions, then the lowest index,
+        so that the choice does not depend on the order in which the guesses were evaluated.
+
+        :param guess_list: array of indices of the evaluated guesses.
+                scores: the score of each guess (see guess_scores).
+                is_possible: boolean array telling which guesses are possible solutions.
+        :return: The index of the best guess.
+    """
+    best = scores == scores.min()
+    if np.any(best & is_possible):
+        best &= is_possible
+    return guess_list[best].min()
+
+
+def minimax_lazy(self, current_list):
     """
         Modified implementation of the mini-max algorithm from Knuth 1977, from Wikipedia:
         <link>https://en.wikipedia.org/wiki/Mastermind_(board_game)</link>
@@ -122,36 +803,28 @@ def minimax_lazy(current_list):
         Uses a simpler (lazy) evaluation function that acts as a heuristic in place of
         a true evaluation with information about in-place and in-colour colours.
 
-        :param current_list: The current list at this point in the game.
-        :return: The next best guess to narrow down the current list.
-    """
-    # Dictionary for storing the occurrences of a given score
-    score_occurrences = {}
+        The lazy evaluation only depends on the colours of the two sequences, so the evaluations
+        of all pairs are computed at once from colour counts (see lazy_evaluation).
 
-    # Iterate through each item in the list, as guess
-    for guess in current_list:
-        guess_score_occurrence = {}
+        :param current_list: The current array of possibilities at this point in the game.
+        :return: The index of the next best guess to narrow down the current list.
+    """
+    # float32 so that the products go through BLAS; the values are small integers and stay exact.
+    counts = self.space.counts(current_list).astype(np.float32)
+    present = (counts > 0).astype(np.float32)
 
-        # Iterate through each item in the list, as sub_guess.
-        for sub_guess in current_list:
+    # Frequency of the lowest score of each guess
+    score_occurrences = np.zeros(len(current_list), dtype=np.int64)
 
-            # Get the evaluation of the sub_guess as if guess were the goal.
-            score = lazy_evaluation(sub_guess, guess)
-            # Maintain the dictionary of scores and their occurrences.
-            if score in guess_score_occurrence:
-                guess_score_occurrence[score] += 1
-            else:
-                guess_score_occurrence[score] = 1
+    for start in range(0, len(current_list), 256):
+        # Evaluation of every sub_guess (rows) as if a guess in the block (columns) were the goal.
+        scores = 2 * (counts @ present[start:start + 256].T) - self.code_length
 
         # Retrieve the frequency of the lowest score.
-        guess_min_score_frequency = min(guess_score_occurrence.items(), key=lambda x: x[0])[1]
+        score_occurrences[start:start + 256] = (scores == scores.min(axis=0, keepdims=True)).sum(axis=0)
 
-        # Add the frequency of the lowest score to the main dictionary, mapping the guess to the frequency.
-        score_occurrences[guess] = guess_min_score_frequency
-
-    # Get the guess with the most frequent and lowest score.
-    min_score = max(score_occurrences, key=lambda x: x[1])
-    return min_score
+    # Get the guess with the most frequent and lowest score, the first one in case of a tie.
+    return current_list[np.argmax(score_occurrences)]
 
 
 def evaluate_guess(guess, target):
@@ -181,26 +854,11 @@ def evaluate_guess(guess, target):
     guess = np.reshape(guess, (-1))
     target = np.reshape(target, (-1))
 
-    I = np.where(guess == target)[0]
-    in_place = len(I)
-    I = np.where(guess != target)[0]
-    state = np.zeros(np.shape(target))
+    colours = sorted(set(guess) | set(target))
+    in_place, in_colour = unpack_feedback(feedback(encode(guess, colours), encode(target, colours), len(colours)),
+                                          len(target))
 
-    in_colour = 0
-    for i in I:
-        a = target[i]
-        for j in I:
-            if state[j] != 0:
-                continue
-
-            b = guess[j]
-
-            if a == b:
-                in_colour += 1
-                state[j] = -1
-                break
-
-    return in_place, in_colour
+    return int(in_place), int(in_colour)
 
 
 def lazy_evaluation(guess, target):
@@ -234,6 +892,172 @@ def average(list):
     """
     return sum(list) / len(list)
 
+def load_strategy_file(self, path):
+    """
+        Loads the moves of a strategy computed offline by solver.py. The file has the format of a
+        strategy book (see StrategyBook), along with the settings of the games it was computed for.
+
+        :param path: the strategy file.
+        :return: A dictionary mapping tuples of packed scores to guess indices.
+    """
+    with open(path) as f:
+        strategy = json.load(f)
+    settings = (strategy['code_length'], strategy['num_colours'], strategy['num_guesses'])
+    if settings != (self.code_length, len(self.colours), self.num_guesses):
+        raise ValueError("Strategy file '%s' is for codes of length %d with %d colours and %d guesses" % ((path,) + settings))
+    return StrategyBook.parse_moves(strategy['moves'])
+
+
+class StrategyBook():
+    """
+        A decision tree of the agent's moves, saved to disk between runs.
+
+        For fixed game settings the agent is deterministic, so its next guess only depends on the
+        scores it received for its previous guesses. The book maps that history of packed scores
+        to the index of the guess made, so that a move that has been searched for once becomes a
+        dictionary lookup. Moves are added as new branches of the tree are reached.
+
+        The book is stored as JSON, with histories as comma separated strings of packed scores.
+    """
+
+    def __init__(self, path):
+        """
+            :param path: the file the book is loaded from and saved to.
+        """
+        self.path = path
+        self.moves = {}
+        self.new_moves = 0
+        if os.path.exists(path):
+            self.moves = self.load(path)
+
+    @staticmethod
+    def load(path):
+        """
+            Loads the moves saved in a book file.
+
+            :param path: the book file.
+            :return: A dictionary mapping tuples of packed scores to guess indices.
+        """
+        with open(path) as f:
+            return StrategyBook.parse_moves(json.load(f)['moves'])
+
+    @staticmethod
+    def parse_moves(moves):
+        """
+            :param moves: the 'moves' dictionary of a book file.
+            :return: A dictionary mapping tuples of packed scores to guess indices.
+        """
+        return {tuple(int(s) for s in history.split(',') if s): guess for history, guess in moves.items()}
+
+    def get(self, history):
+        """
+            :param history: tuple of the packed scores of the guesses made so far in a game.
+            :return: The index of the next guess, or None if this branch has not been reached yet.
+        """
+        return self.moves.get(history)
+
+    def add(self, history, guess):
+        """
+            Records the guess made after the given history of scores.
+        """
+        self.moves[history] = int(guess)
+        self.new_moves += 1
+
+    def save_due(self):
+        """
+            Whether enough moves were added since the last save to save the book again: at least a quarter
+            of the book, so that the cost of rewriting it stays proportional to its final size however
+            many games add moves. The book is also saved at exit, but worker processes of a parallel run
+            exit without running atexit, so they rely on these saves.
+        """
+        return self.new_moves >= max(64, len(self.moves) // 4)
+
+    def save(self):
+        """
+            Saves the book if it has new moves. Moves saved by other processes sharing the file in
+            the meantime are merged in, and the file is replaced atomically.
+        """
+        if self.new_moves == 0:
+            return
+        if os.path.exists(self.path):
+            self.moves = {**self.load(self.path), **self.moves}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump({'moves': {','.join(str(s) for s in history): guess for history, guess in self.moves.items()}}, f)
+        os.replace(tmp_path, self.path)
+        self.new_moves = 0
+
+
+class TranspositionCache():
+    """
+        A bounded cache of the guesses chosen for pools of possible solutions.
+
+        Games that receive the same scores for the same guesses end up with the same pool of possible
+        solutions, for which the search always chooses the same guess. The pool is always sorted, so a
+        hash of its bytes identifies it. Least recently used entries are evicted when the estimated
+        memory used by the cache goes over max_bytes.
+    """
+
+    # Estimated memory of an entry, besides its key: the dictionary slot, the links of the ordered
+    # dictionary and the int guess (or float cost, see follow_up_cost).
+    ENTRY_BYTES = 150
+
+    def __init__(self, max_bytes):
+        """
+            :param max_bytes: the memory cap of the cache in bytes.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(current_list):
+        """
+            :param current_list: a sorted array of indices of possible solutions.
+            :return: A 16 byte hash of the array.
+        """
+        return hashlib.blake2b(np.ascontiguousarray(current_list).tobytes(), digest_size=16).digest()
+
+    def get(self, key):
+        """
+            :return: The cached guess for the key, or None if there is none.
+        """
+        guess = self.entries.get(key)
+        if guess is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return guess
+
+    def put(self, key, guess):
+        """
+            Caches the guess for the key, evicting least recently used entries if needed.
+        """
+        if key not in self.entries:
+            self.num_bytes += len(key) + self.ENTRY_BYTES
+        self.entries[key] = guess
+        self.entries.move_to_end(key)
+        while self.num_bytes > self.max_bytes and self.entries:
+            evicted, _ = self.entries.popitem(last=False)
+            self.num_bytes -= len(evicted) + self.ENTRY_BYTES
+            self.evictions += 1
+
+    def stats(self):
+        """
+            :return: A dictionary of the counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.num_bytes,
+                'hit_rate': round(self.hits / lookups, 4) if lookups > 0 else 0.0}
+
+
 class MastermindAgent():
     """
              A class that encapsulates the code dictating the
@@ -254,23 +1078,119 @@ class MastermindAgent():
              -------
              AgentFunction(percepts)
                  Returns the next guess of the colours on the board
+
+             stats()
+                 Returns statistics of the agent's caches
              """
 
-    def __init__(self, code_length, colours, num_guesses):
+    def __init__(self, code_length, colours, num_guesses, time_budget=None):
         """
       :param code_length: the length of the code to guess
       :param colours: list of letter representing colours used to play
       :param num_guesses: the max. number of guesses per game
+      :param time_budget: max. time in seconds spent on the search for a move, None for no limit
       """
         self.code_length = code_length
         self.colours = colours
         self.num_guesses = num_guesses
 
-        # Store a copy of all possibilities as a main list. Minor performance improvement for my laptop.
-        self.true_list = list(product(list(self.colours), repeat=self.code_length))
-
-        # Used for data analysis
-        self.after_first_guess_list = []
+        # Time budget of a move, the deadline of the current move, and whether the search of the current
+        # move finished before the deadline.
+        self.time_budget = time_budget
+        self.deadline = None
+        self.search_complete = True
+        self.num_moves = 0
+        self.budget_hits = 0
+
+        # The space of all codes, addressed by code index and decoded on demand; shared by all agents
+        # of the process with the same settings.
+        self.space = code_space(self.code_length, len(self.colours))
+
+        # Precomputed feedback between all pairs of codes, shared between processes through a memory-mapped
+        # file (None if the code space is too large to cache).
+        self.feedback_matrix = feedback_matrix(self.code_length, len(self.colours))
+
+        # Whether minimax also considers guesses that can no longer be the solution (Knuth's choice). The order
+        # in which they are evaluated is computed here rather than in the time of a move.
+        self.full_space_guesses = True
+        if self.full_space_guesses and self.space.size <= MAX_EXACT_SCORES:
+            self.space.by_distinct_colours()
+
+        # Whether minimax skips guesses symmetric to others given the history of the game (see reduce_guesses),
+        # and the number of searches, of guesses they were given and of guesses they evaluated.
+        self.use_symmetry = True
+        self.symmetry_searches = 0
+        self.symmetry_guesses = 0
+        self.symmetry_evaluated = 0
+
+        # Sampled minimax (see minimax_sampled): the size of the pool of possibilities above which it is used,
+        # the number of possibilities it samples and the number of guesses it evaluates.
+        self.sample_threshold = game_settings.get('sampleThreshold', 2000)
+        self.sample_size = game_settings.get('sampleSize', 1000)
+        self.sample_probes = game_settings.get('sampleProbes', 500)
+
+        # Scorer of the guesses of minimax (see STRATEGIES), None for minimax_lazy.
+        self.strategy_name = game_settings.get('strategy', 'worst_case')
+        if self.strategy_name not in STRATEGIES:
+            raise ValueError("Unknown strategy '%s' (expecting one of %s)" % (self.strategy_name, list(STRATEGIES)))
+        self.scorer = STRATEGIES[self.strategy_name]
+
+        # Whether minimax drops guesses that cannot beat the best one found so far (see pruned_scores), and the
+        # number of (guess, possibility) pairs it had to score and did score. Pruning pays off when the scores are
+        # computed by the feedback kernel; lookups in the feedback matrix are cheaper than the bookkeeping, and
+        # the bound of most_parts is too loose to drop anything.
+        self.prune = self.feedback_matrix is None and self.scorer is not most_parts_score
+        self.pairs_total = 0
+        self.pairs_scored = 0
+
+        # Two-ply search (see minimax_lookahead): whether it is on, the number of guesses it searches deeper, its
+        # time cap per move in seconds, the number of searches and of searches cut short by the cap.
+        self.lookahead = game_settings.get('lookahead', False) and self.scorer is not None
+        self.lookahead_width = game_settings.get('lookaheadWidth', 16)
+        self.lookahead_cap = game_settings.get('lookaheadTimeCap', 1.0)
+        self.lookahead_searches = 0
+        self.lookahead_cutoffs = 0
+
+        # Name of the strategy, used to tell apart the strategy books of different strategies.
+        self.strategy = 'minimax_full' if self.full_space_guesses else 'minimax'
+        if self.strategy_name != 'worst_case':
+            self.strategy = self.strategy_name + '_' + self.strategy
+        if self.lookahead:
+            self.strategy += '_lookahead_%d' % self.lookahead_width
+        self.strategy += '_sampled_%d_%d_%d' % (self.sample_threshold, self.sample_size, self.sample_probes)
+
+        # Decision tree of moves saved to disk between runs, if enabled in settings.
+        self.book = None
+        if game_settings.get('strategyBook', False):
+            self.book = StrategyBook(book_path(self))
+            atexit.register(self.book.save)
+
+        # Moves of a strategy computed offline by solver.py, if set in settings, played before the book.
+        self.strategy_table = None
+        if game_settings.get('strategyFile') is not None:
+            self.strategy_table = load_strategy_file(self, game_settings['strategyFile'])
+
+        # Guesses chosen for pools of possible solutions already searched by this agent.
+        self.search_cache = None
+        if game_settings.get('searchCacheBytes', 0) > 0:
+            self.search_cache = TranspositionCache(game_settings['searchCacheBytes'])
+
+        # Costs of the pools of possible solutions searched by minimax_lookahead (see follow_up_cost).
+        self.subtree_cache = TranspositionCache(game_settings.get('lookaheadCacheBytes', 2**26))
+
+        # (guess index, packed score) of each guess of the current game, and the array of indices of its
+        # possible solutions (None when it has to be rebuilt from the history). All of the state of a game is
+        # kept in the agent, so agents of the same process do not interfere with each other.
+        self.history = []
+        self.possibles = None
+
+        # Whether a move of the current game was cut short by the time budget, after which the game is
+        # neither played from nor saved to the book.
+        self.off_book = False
+
+        # The first guess, and the pools of possible solutions after it for each of its scores.
+        self.first_guess = to_index(self, initial_guess(self))
+        self.after_first_guess_list = get_after_first_guess_list(self)
 
 
     def AgentFunction(self, percepts):
@@ -292,26 +1212,97 @@ class MastermindAgent():
 
             :return: list of chars - a list of code_length chars constituting the next guess
             """
-        global possibles
         # Extract different parts of percepts.
         guess_counter, last_guess, in_place, in_colour = percepts
 
-        # New tuple for passing to update_list function
-        score_tuple = (in_place, in_colour)
+        # The search stops short of the budget, leaving time for the rest of the move.
+        if self.time_budget is not None:
+            self.deadline = time.perf_counter() + 0.8 * self.time_budget
+        self.search_complete = True
+        self.num_moves += 1
+
+        # Keep the history of (guess, packed score) of this game.
+        if guess_counter == 0:
+            if self.book is not None and self.book.save_due():
+                self.book.save()
+            self.history = []
+            self.possibles = None
+            self.off_book = False
+        else:
+            self.history.append((to_index(self, last_guess), pack_feedback(in_place, in_colour, self.code_length)))
+
+        # Play from the strategy file, or from the book if this branch of the game has been reached before.
+        # The pool of possible solutions is then not updated, and gets rebuilt from the history if the game
+        # leaves the table.
+        scores = tuple(int(score) for _, score in self.history)
+        if self.strategy_table is not None:
+            best_guess = self.strategy_table.get(scores)
+            if best_guess is not None:
+                self.possibles = None
+                return to_colours(self, best_guess)
+        if self.book is not None and not self.off_book:
+            best_guess = self.book.get(scores)
+            if best_guess is not None:
+                self.possibles = None
+                return to_colours(self, best_guess)
 
         # Check the state of the game, creates our list of combinations.
         if guess_counter == 0:
-            possibles = get_initial_list(self)
-            actions = initial_guess(self)
-            possibles.remove(tuple(actions))
-            return actions
+            self.possibles = get_initial_list(self)
+            best_guess = to_index(self, initial_guess(self))
 
         # Update the pool of possible solutions
         else:
-            possibles = update_list(possibles, last_guess, score_tuple)
-
-        # Select the next best guess, removing it from the pool of possible solutions.
-        actions = list(get_best_guess(possibles))
-        possibles.remove(tuple(actions))
-
-        return actions
+            # The first guess is always the same, so the pool after it and the second guess only depend
+            # on its score and are shared across games.
+            if guess_counter == 1 and self.history[0][0] == self.first_guess:
+                self.possibles = get_after_first_guess(self, self.history[0][1])
+                best_guess = get_second_guess(self, self.history[0][1])
+            else:
+                if self.possibles is None:
+                    self.possibles = replay_history(self, self.history)
+                else:
+                    self.possibles = update_list(self, self.possibles, *self.history[-1])
+
+                # Select the next best guess, unless it is known for this pool of possible solutions.
+                best_guess = None
+                if self.search_cache is not None:
+                    key = self.search_cache.key(self.possibles)
+                    best_guess = self.search_cache.get(key)
+                if best_guess is None:
+                    best_guess = get_best_guess(self, self.possibles)
+                    if self.search_cache is not None and self.search_complete:
+                        self.search_cache.put(key, best_guess)
+
+        # Remove the guess from the pool of possible solutions.
+        self.possibles = self.possibles[self.possibles != best_guess]
+
+        # Moves of searches cut short by the time budget are not saved, and neither are the later moves
+        # of the game: the book is keyed by scores alone, and the game has left the book's branch.
+        if not self.search_complete:
+            self.budget_hits += 1
+            self.off_book = True
+        elif self.book is not None and not self.off_book:
+            self.book.add(scores, best_guess)
+
+        return to_colours(self, best_guess)
+
+    def stats(self):
+        """Returns a dictionary of statistics of the agent's caches, reported at the end of a run"""
+        stats = {}
+        if self.time_budget is not None:
+            stats['time_budget'] = {'seconds': self.time_budget, 'moves': self.num_moves,
+                                    'budget_hits': self.budget_hits}
+        if self.search_cache is not None:
+            stats['search_cache'] = self.search_cache.stats()
+        if self.symmetry_searches > 0:
+            stats['symmetry'] = {'searches': self.symmetry_searches, 'guesses': self.symmetry_guesses,
+                                 'evaluated': self.symmetry_evaluated,
+                                 'ratio': round(self.symmetry_evaluated / self.symmetry_guesses, 4)}
+        if self.lookahead_searches > 0:
+            stats['lookahead'] = {'searches': self.lookahead_searches, 'cutoffs': self.lookahead_cutoffs,
+                                  'subtrees': self.subtree_cache.stats()}
+        if self.prune and self.pairs_total > 0:
+            stats['pruning'] = {'pairs': self.pairs_total, 'scored': self.pairs_scored,
+                                'rate': round(1 - self.pairs_scored / self.pairs_total, 4)}
+        return stats
@@ -24,6 +24,9 @@ class MastermindAgent():
              -------
              AgentFunction(percepts)
                  Returns the next guess of the colours on the board
+
+             AgentFunctionBatch(percepts_batch)
+                 Returns the next guesses for a batch of games played in lockstep
              """
 
    def __init__(self, code_length,  colours, num_guesses):
@@ -67,3 +70,18 @@ class MastermindAgent():
 
       # Return a random guess
       return action
+
+   def AgentFunctionBatch(self, percepts_batch):
+      """Returns the next board guesses for a batch of games given their states in percepts_batch
+
+            :param percepts_batch: a tuple of five arrays: game_ids, guess_counters, last_guesses, in_place, in_colour
+
+                     , where row i of each array holds the state of game game_ids[i], as in percepts of AgentFunction
+
+            :return: a len(game_ids) x code_length numpy array of chars constituting the next guesses
+            """
+
+      game_ids, guess_counters, last_guesses, in_place, in_colour = percepts_batch
+
+      # Make a random choice of colour character for each game
+      return np.random.choice(self.colours, size=(len(game_ids), self.code_length))
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# Marks unused guess slots in binary records
+NO_GUESS = 255
+
+def record_dtype(code_length, num_guesses):
+   """ Returns the numpy dtype of a binary game record
+
+         :param code_length: the length of the code
+
+                num_guesses: max. number of guesses per game
+
+         :return: a structured dtype with fields game, score, seconds, target (colour indices) and guesses
+                  (colour indices, rows of unused guesses filled with NO_GUESS)
+         """
+   return np.dtype([('game', '<u4'), ('score', '<u2'), ('seconds', '<f4'),
+                    ('target', 'u1', (code_length,)), ('guesses', 'u1', (num_guesses, code_length))])
+
+class ResultSink:
+   """ Destination of the per-game results of MastermindGame.run
+
+         Game records are streamed to a file as they come in, either as JSON lines (one object per game with keys
+         game, target, guesses, score and seconds) or, for file names ending with '.bin', as fixed-size binary
+         records (see record_dtype) that can be read back with read_results.
+
+         Progress is printed at most once every progress_interval seconds, and not at all in quiet mode.
+         Without a file and in quiet mode no per-game work is done at all.
+         """
+
+   def __init__(self, colours, code_length, num_guesses, path=None, progress_interval=1.0, quiet=False, mode='w'):
+      """
+      :param colours: list of colour characters of the game
+      :param code_length: the length of the code
+      :param num_guesses: max. number of guesses per game
+      :param path: file the records are written to, None for no records
+      :param progress_interval: min. number of seconds between progress reports
+      :param quiet: if True, nothing is printed
+      :param mode: 'w' to start a new file, 'a' to append to an existing one
+      """
+      self.colours = list(colours)
+      self.code_length = code_length
+      self.num_guesses = num_guesses
+      self.path = path
+      self.progress_interval = progress_interval
+      self.quiet = quiet
+      self.last_progress = None
+
+      self.file = None
+      self.binary = path is not None and path.endswith('.bin')
+      if path is not None:
+         self.file = open(path, mode + ('b' if self.binary else ''))
+         if self.binary:
+            self.dtype = record_dtype(code_length, num_guesses)
+
+   @property
+   def recording(self):
+      """ True if game records are written to a file """
+      return self.file is not None
+
+   def add(self, game, target, guesses, score, seconds):
+      """ Writes the record of a game
+
+            :param game: index of the game in the run
+
+                   target: the target board as a uint8 array of colour indices
+
+                   guesses: list of the guesses, each a uint8 array of colour indices
+
+                   score: the score of the game
+
+                   seconds: the time the game took
+            """
+      if self.file is None:
+         return
+
+      if self.binary:
+         record = np.zeros(1, dtype=self.dtype)
+         record['game'] = game
+         record['score'] = score
+         record['seconds'] = seconds
+         record['target'] = target
+         record['guesses'] = NO_GUESS
+         for i, guess in enumerate(guesses[:self.num_guesses]):
+            record['guesses'][0, i] = guess
+         self.file.write(record.tobytes())
+      else:
+         self.file.write(json.dumps({'game': int(game), 'target': ''.join(self.colours[c] for c in target),
+                                     'guesses': [''.join(self.colours[c] for c in guess) for guess in guesses],
+                                     'score': int(score), 'seconds': seconds}) + "\n")
+
+   def progress(self, report, game_count, num_games):
+      """ Calls report, unless in quiet mode or if the last report was less than progress_interval seconds ago
+
+            :param report: function printing the progress
+
+                   game_count: number of games played so far
+
+                   num_games: total number of games; the last game is always reported
+            """
+      if self.quiet:
+         return
+      now = time.time()
+      if game_count < num_games and self.last_progress is not None and now - self.last_progress < self.progress_interval:
+         return
+      self.last_progress = now
+      report()
+
+   def flush(self):
+      if self.file is not None:
+         self.file.flush()
+
+   def close(self):
+      if self.file is not None:
+         self.file.close()
+         self.file = None
+
+def read_results(path, code_length=None, num_guesses=None):
+   """ Reads the records written by ResultSink
+
+         :param path: the results file
+
+                code_length: the length of the code (binary files only)
+
+                num_guesses: max. number of guesses per game (binary files only)
+
+         :return: a list of dictionaries for JSON lines files, a structured numpy array for binary files
+         """
+   if path.endswith('.bin'):
+      return np.fromfile(path, dtype=record_dtype(code_length, num_guesses))
+
+   with open(path) as f:
+      return [json.loads(line) for line in f if line.strip()]
+
+# Directory of the per-game results saved by ResultCache, one file per agent and configuration
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.results_cache')
+
+class ResultCache:
+   """ Persistent per-game results of MastermindGame.run
+
+         The results of each game are appended, as soon as the game ends, to a binary file of records (see
+         record_dtype) named after a hash of the agent file's content, the game settings and the seed, so that a run
+         that is interrupted resumes with the games it has not played yet and a run of an unchanged agent and
+         configuration is served from the file.  A record cut short by an interruption is dropped.
+         """
+
+   def __init__(self, agentFile, config, colours, code_length, num_guesses, cache_dir=None):
+      """
+      :param agentFile: name of the agent file
+      :param config: dictionary of everything else the results depend on (settings, seed, ...), JSON serialisable
+      :param colours: list of colour characters of the game
+      :param code_length: the length of the code
+      :param num_guesses: max. number of guesses per game
+      :param cache_dir: directory of the cache, CACHE_DIR if None
+      """
+      with open(agentFile, 'rb') as f:
+         agent_hash = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+      key = hashlib.blake2b(json.dumps({'agent': agent_hash, 'config': config}, sort_keys=True).encode(),
+                            digest_size=16).hexdigest()
+
+      if cache_dir is None:
+         cache_dir = CACHE_DIR
+      self.path = os.path.join(cache_dir, "%s_%s.bin" % (os.path.splitext(os.path.basename(agentFile))[0], key))
+      self.dtype = record_dtype(code_length, num_guesses)
+      self.colours = colours
+      self.code_length = code_length
+      self.num_guesses = num_guesses
+      self.sink = None
+
+   def load(self, num_games, targets):
+      """ Reads the cached results of the games of a run
+
+            :param num_games: number of games of the run
+
+                   targets: function returning the target boards (uint8 arrays of colour indices, one row per game) of
+                            an array of game indices, records of other boards are ignored
+
+            :return: a dictionary mapping game index to (score, seconds, guesses) for the cached games, where guesses
+                     is a list of uint8 arrays of colour indices
+            """
+      if not os.path.exists(self.path):
+         return {}
+
+      # Drop a record left incomplete by an interrupted run
+      size = os.path.getsize(self.path)
+      if size % self.dtype.itemsize != 0:
+         os.truncate(self.path, size - size % self.dtype.itemsize)
+
+      records = np.fromfile(self.path, dtype=self.dtype)
+      records = records[records['game'] < num_games]
+      records = records[np.all(records['target'] == targets(records['game']), axis=1)]
+
+      cached = {}
+      for record in records:
+         game = int(record['game'])
+         guesses = [guess for guess in record['guesses'] if guess[0] != NO_GUESS]
+         cached[game] = (int(record['score']), float(record['seconds']), guesses)
+      return cached
+
+   def add(self, game, target, guesses, score, seconds):
+      """ Saves the results of a game (see ResultSink.add) """
+      if self.sink is None:
+         os.makedirs(os.path.dirname(self.path), exist_ok=True)
+         self.sink = ResultSink(self.colours, self.code_length, self.num_guesses, path=self.path, quiet=True,
+                                mode='a')
+      self.sink.add(game, target, guesses, score, seconds)
+      self.sink.flush()
+
+   def close(self):
+      if self.sink is not None:
+         self.sink.close()
+         self.sink = None
@@ -10,7 +10,7 @@ game_settings = {
 
    "codeLength": 5,              # length of the code to guess
 
-   "numberOfColours": 6,         # number of colours (1-6)
+   "numberOfColours": 6,         # number of colours (1-26)
 
    "maxNumberOfGuesses": 6,     # max. number of guesses per game
 
@@ -18,6 +18,50 @@ game_settings = {
 
    "verbose": False,
 
+   "tournamentAgents": None,     # list of agent files played on the same boards and ranked, e.g. ["my_agent.py", "random_agent.py"]; None to play agentFile
+
+   "numWorkers": 1,              # number of worker processes playing games in parallel, None for one per CPU
+
+   "useThreads": False,          # True to play the games of numWorkers on threads instead of processes (for agents whose NumPy work releases the GIL)
+
+   "batchSize": 1,               # number of games played in lockstep by agents implementing AgentFunctionBatch
+
+   "strategyBook": False,        # True for my_agent to save its moves in a decision tree and replay them in later games
+
+   "strategyFile": None,         # file of a strategy computed by solver.py that my_agent plays by table lookup, None for none
+
+   "searchCacheBytes": 2**26,    # memory cap of my_agent's cache of searched positions in bytes, 0 to disable it
+
+   "profileFile": None,          # file the timing report of the phases of each guess is saved to, None for no profiling
+
+   "resultCache": False,         # True to keep the result of each game in .results_cache, so that interrupted runs resume and runs of an unchanged agent and settings are read back instead of replayed
+
+   "resultsFile": None,          # file the record of each game is streamed to (.jsonl, or .bin for binary), None for none
+
+   "progressInterval": 1.0,      # min. number of seconds between progress reports
+
+   "quiet": False,               # True to print nothing while the games are played
+
+   "moveTimeBudget": None,       # max. number of seconds the agent may spend on a guess, None for no limit
+
+   "strictTimeBudget": False,    # True to stop the game with an error when the agent goes over the time budget
+
+   "strategy": "worst_case",     # how my_agent ranks guesses: worst_case, expected_size, entropy, most_parts or lazy
+
+   "lookahead": False,           # True for my_agent to search its best guesses two moves deep, minimising the expected number of guesses
+
+   "lookaheadWidth": 16,         # number of best guesses searched two moves deep
+
+   "lookaheadTimeCap": 1.0,      # max. number of seconds of the two-move search of a guess (the best guess searched so far is played)
+
+   "lookaheadCacheBytes": 2**26, # memory cap of my_agent's cache of the pools searched two moves deep in bytes
+
+   "sampleThreshold": 2000,      # number of possible solutions above which my_agent switches to sampled minimax
+
+   "sampleSize": 1000,           # number of possible solutions sampled to estimate partition sizes (more is slower but better)
+
+   "sampleProbes": 500,          # number of guesses evaluated by sampled minimax (more is slower but better)
+
    "seed": 0                    # seed for random choices of words in the game, None for random seed
 
 }
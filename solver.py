@@ -0,0 +1,320 @@
+# Offline solver of the strategy of my_agent that minimises the expected score of a game.
+#
+# Usage:
+#
+#    python solver.py                                      # settings of settings.py
+#    python solver.py --length 4 --colours 6 --guesses 6   # other settings
+#    python solver.py --width 0                            # every guess at every move (small games only)
+#
+# The games are scored as MastermindGame.play scores them: the number of guesses of a solved game, twice the max.
+# number of guesses of an unsolved one.  The subtrees of the first guess are solved on a pool of worker processes,
+# and each solved subtree is saved to a checkpoint file as soon as it is done, so that an interrupted solve resumes
+# where it stopped.  The strategy is saved in the format of my_agent's strategy books, and is played by my_agent
+# with the strategyFile setting.
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+from settings import game_settings
+from feedback import pack_feedback, unpack_feedback
+import mastermind
+import my_agent
+
+class Solver:
+   """ Depth-first search of the strategy with the lowest total score over a pool of possible solutions
+
+         At every move, the guesses are the `width` best guesses of my_agent's minimax (see my_agent.ranked_guesses),
+         with guesses symmetric to others given the history of the game left out, or all guesses if width is None.
+         The search is exhaustive over these guesses, with branch and bound: the parts of the partition of a guess
+         are solved one at a time, largest first, each with the bound left by the best guess found so far, and
+         guesses whose lower bound (see lower_bound) cannot beat it are not searched.  A move that reaches the lower
+         bound of its pool ends the search of the pool.
+
+         Strategies are memoized by pool and number of guesses made, as different histories often lead to the same
+         pool.
+         """
+
+   def __init__(self, agent, num_guesses, width=None):
+      """
+      :param agent: a my_agent.MastermindAgent, which provides the code space, the scores and the ranking of guesses
+      :param num_guesses: max. number of guesses per game
+      :param width: number of guesses searched at each move, None for all
+      """
+      self.agent = agent
+      self.num_guesses = num_guesses
+      self.width = width
+      self.solved = pack_feedback(agent.code_length, 0, agent.code_length)
+      self.memo = {}
+      self.nodes = 0
+
+   def lower_bound(self, size, depth):
+      """ The lowest total score of a pool after depth guesses: one possible solution is solved with the next
+          guess, and all others with the guess after it at best
+
+            :param size: number of possible solutions
+
+                   depth: number of guesses made
+
+            :return: the lower bound of the total score of the pool
+            """
+      if size == 0:
+         return 0
+      if depth >= self.num_guesses:
+         return 2 * self.num_guesses * size
+      later = depth + 2 if depth + 2 <= self.num_guesses else 2 * self.num_guesses
+      return depth + 1 + (size - 1) * later
+
+   def guesses(self, pool, history):
+      """ The guesses searched for a pool
+
+            :param pool: array of indices of the possible solutions, sorted
+
+                   history: list of (guess index, packed score) of the guesses made so far
+
+            :return: array of indices of the guesses
+            """
+      # One of two possible solutions is always as good as any other guess
+      if len(pool) <= 2:
+         return pool[:1]
+      # Symmetries of the pool are found from the guesses made so far
+      self.agent.history = history
+      width = self.agent.space.size if self.width is None else self.width
+      return my_agent.ranked_guesses(self.agent, pool, width, self.agent.full_space_guesses)
+
+   def solve(self, pool, history, bound=np.inf):
+      """ Searches the strategy with the lowest total score over a pool of possible solutions
+
+            :param pool: array of indices of the possible solutions, sorted
+
+                   history: list of (guess index, packed score) of the guesses made so far
+
+                   bound: the search gives up on strategies whose total score is bound or more
+
+            :return: a tuple (total score, moves), where moves maps tuples of packed scores of the guesses made from
+                     this pool to the index of the next guess, or (inf, None) if no strategy beats bound
+            """
+      depth = len(history)
+      if depth >= self.num_guesses:
+         return self.lower_bound(len(pool), depth), {}
+      if len(pool) == 1:
+         return depth + 1, {(): int(pool[0])}
+
+      floor = self.lower_bound(len(pool), depth)
+      if floor >= bound:
+         return np.inf, None
+
+      key = (my_agent.TranspositionCache.key(pool), depth)
+      if key in self.memo:
+         total, moves = self.memo[key]
+         return (total, moves) if total < bound else (np.inf, None)
+
+      self.nodes += 1
+      best, best_moves = bound, None
+      for guess in self.guesses(pool, history):
+         # Parts of the partition, each sorted like pool, largest first
+         scores = my_agent.get_scores(self.agent, [guess], pool)[0]
+         order = np.argsort(scores, kind='stable')
+         bounds = np.flatnonzero(np.diff(scores[order])) + 1
+         parts = sorted(zip(scores[order][np.r_[0, bounds]], np.split(pool[order], bounds)), key=lambda p: -len(p[1]))
+
+         floors = [depth + 1 if score == self.solved else self.lower_bound(len(part), depth + 1) for score, part in parts]
+         total = sum(floors)
+         if total >= best:
+            continue
+
+         moves = {(): int(guess)}
+         for (score, part), part_floor in zip(parts, floors):
+            if score == self.solved:
+               continue
+            cost, part_moves = self.solve(part, history + [(int(guess), int(score))], best - (total - part_floor))
+            total += cost - part_floor
+            if total >= best:
+               break
+            moves.update({(int(score),) + scores_after: move for scores_after, move in part_moves.items()})
+
+         if total < best:
+            best, best_moves = total, moves
+            if best == floor:
+               break
+
+      if best_moves is None:
+         return np.inf, None
+      self.memo[key] = (best, best_moves)
+      return best, best_moves
+
+def first_partition(agent, first_guess):
+   """ The pools of possible solutions left by the first guess
+
+         :return: a dictionary mapping each packed score, but that of a solved game, to a sorted array of indices
+         """
+   pool = agent.space.indices()
+   scores = my_agent.get_scores(agent, [first_guess], pool)[0]
+   solved = pack_feedback(agent.code_length, 0, agent.code_length)
+   return {int(score): pool[scores == score] for score in np.unique(scores) if score != solved}
+
+def first_guesses(agent, search_all):
+   """ The first guesses solved for
+
+         :param search_all: if True, one guess of each set of symmetric codes, else the first guess of my_agent
+
+         :return: list of code indices
+         """
+   if not search_all:
+      return [agent.first_guess]
+   agent.history = []
+   pool = agent.space.indices()
+   guesses, _ = my_agent.reduce_guesses(agent, pool, np.ones(len(pool), dtype=bool), pool)
+   return [int(guess) for guess in guesses]
+
+def _init_worker(code_length, num_colours, num_guesses, width, settings):
+   global _worker_solver
+
+   game_settings.update(settings)
+   agent = my_agent.MastermindAgent(code_length, mastermind.COLOURS[:num_colours], num_guesses)
+   _worker_solver = Solver(agent, num_guesses, width)
+
+def _solve_job(job):
+   """ Solves the subtree of a score of a first guess in a worker process
+
+         :param job: a tuple (first guess index, packed score)
+
+         :return: a tuple (job, total score, moves, number of pools searched, seconds)
+         """
+   first_guess, score = job
+   start = time.perf_counter()
+   solver = _worker_solver
+   solver.memo = {}
+   solver.nodes = 0
+   pool = first_partition(solver.agent, first_guess)[score]
+   total, moves = solver.solve(pool, [(first_guess, score)])
+   return job, total, moves, solver.nodes, time.perf_counter() - start
+
+def encode_moves(moves):
+   """ Moves keyed by tuples of packed scores, as saved in strategy books """
+   return {','.join(str(s) for s in history): int(guess) for history, guess in moves.items()}
+
+def load_checkpoint(path, config):
+   """ Reads the subtrees solved so far by a solve of the same configuration
+
+         :return: a dictionary mapping (first guess, packed score) to (total score, moves as saved)
+         """
+   if not os.path.exists(path):
+      return {}
+   with open(path) as f:
+      checkpoint = json.load(f)
+   if checkpoint['config'] != config:
+      return {}
+   return {tuple(int(k) for k in key.split(':')): (value['total'], value['moves'])
+           for key, value in checkpoint['subtrees'].items()}
+
+def save_json(path, data):
+   """ Replaces a file atomically """
+   os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+   tmp_path = "%s.%d.tmp" % (path, os.getpid())
+   with open(tmp_path, 'w') as f:
+      json.dump(data, f)
+   os.replace(tmp_path, path)
+
+def solve(code_length, num_colours, num_guesses, width, num_workers, search_all, checkpoint_path, quiet=False):
+   """ Solves the strategy of the game, first guess included
+
+         :param code_length: the length of the code
+
+                num_colours: number of colours
+
+                num_guesses: max. number of guesses per game
+
+                width: number of guesses searched at each move, None for all
+
+                num_workers: number of worker processes, None for one per CPU
+
+                search_all: if True, every first guess (up to symmetry) is solved for, else my_agent's
+
+                checkpoint_path: file the solved subtrees are saved to
+
+         :return: a tuple (expected score, moves as saved in strategy books)
+         """
+   colours = mastermind.COLOURS[:num_colours]
+   # The ranking of guesses depends on the strategy setting; books and moves of earlier searches must not leak in
+   settings = {'strategy': game_settings.get('strategy', 'worst_case'), 'strategyBook': False, 'strategyFile': None,
+               'lookahead': False}
+   # lazy does not rank guesses
+   if my_agent.STRATEGIES[settings['strategy']] is None:
+      settings['strategy'] = 'worst_case'
+   game_settings.update(settings)
+   agent = my_agent.MastermindAgent(code_length, colours, num_guesses)
+
+   config = {'code_length': code_length, 'num_colours': num_colours, 'num_guesses': num_guesses, 'width': width,
+             'strategy': settings['strategy']}
+   subtrees = load_checkpoint(checkpoint_path, config)
+
+   firsts = first_guesses(agent, search_all)
+   partitions = {guess: first_partition(agent, guess) for guess in firsts}
+   jobs = [(guess, score) for guess in firsts for score in partitions[guess] if (guess, score) not in subtrees]
+   jobs.sort(key=lambda job: -len(partitions[job[0]][job[1]]))
+   if not quiet:
+      print("%d first guess(es), %d subtrees solved, %d to solve" % (len(firsts), len(subtrees), len(jobs)))
+
+   start = time.perf_counter()
+   with multiprocessing.Pool(processes=num_workers, initializer=_init_worker,
+                             initargs=(code_length, num_colours, num_guesses, width, settings)) as pool:
+      for count, (job, total, moves, nodes, seconds) in enumerate(pool.imap_unordered(_solve_job, jobs), start=1):
+         subtrees[job] = (int(total), encode_moves(moves))
+         save_json(checkpoint_path, {'config': config,
+                                     'subtrees': {"%d:%d" % key: {'total': value[0], 'moves': value[1]}
+                                                  for key, value in subtrees.items()}})
+         if not quiet:
+            in_place, in_colour = unpack_feedback(job[1], code_length)
+            size = len(partitions[job[0]][job[1]])
+            print("[%d/%d] %s scored (%d, %d): %d possible solutions, average score %.4f, %d pools searched in %.1f s "
+                  "(%.0f s elapsed)" % (count, len(jobs), ''.join(my_agent.to_colours(agent, job[0])), in_place,
+                                        in_colour, size, total / size, nodes, seconds, time.perf_counter() - start))
+
+   # The first guess solves the game when it is the solution
+   totals = {guess: 1 + sum(subtrees[(guess, score)][0] for score in partitions[guess]) for guess in firsts}
+   first_guess = min(firsts, key=lambda guess: (totals[guess], guess))
+
+   moves = {'': first_guess}
+   for score in partitions[first_guess]:
+      for history, guess in subtrees[(first_guess, score)][1].items():
+         moves[','.join(s for s in (str(score), history) if s)] = guess
+   return totals[first_guess] / agent.space.size, moves
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Offline solver of the strategy of my_agent")
+   parser.add_argument('--length', type=int, default=game_settings['codeLength'], help="length of the code")
+   parser.add_argument('--colours', type=int, default=game_settings['numberOfColours'], help="number of colours")
+   parser.add_argument('--guesses', type=int, default=game_settings['maxNumberOfGuesses'],
+                       help="max. number of guesses per game")
+   parser.add_argument('--width', type=int, default=8,
+                       help="number of best guesses of minimax searched at each move, 0 for all")
+   parser.add_argument('--workers', type=int, default=game_settings['numWorkers'],
+                       help="number of worker processes, 0 for one per CPU")
+   parser.add_argument('--all-first-guesses', action='store_true',
+                       help="solve for every first guess (up to symmetry) instead of my_agent's")
+   parser.add_argument('--checkpoint', default=None, help="file the solved subtrees are saved to")
+   parser.add_argument('--output', default=None, help="file the strategy is saved to")
+   parser.add_argument('--quiet', action='store_true', help="print nothing while solving")
+   args = parser.parse_args(argv)
+
+   name = "solved_%dx%d_%d_w%d" % (args.length, args.colours, args.guesses, args.width)
+   checkpoint = args.checkpoint or os.path.join(my_agent.BOOK_DIR, name + ".checkpoint.json")
+   output = args.output or os.path.join(my_agent.BOOK_DIR, name + ".json")
+
+   expected, moves = solve(args.length, args.colours, args.guesses, args.width or None, args.workers or None,
+                           args.all_first_guesses, checkpoint, args.quiet)
+
+   save_json(output, {'code_length': args.length, 'num_colours': args.colours, 'num_guesses': args.guesses,
+                      'expected_score': expected, 'moves': moves})
+   print("Expected score %.4f, %d moves saved to %s" % (expected, len(moves), output))
+   print("Set \"strategyFile\": %s in settings.py to play it" % json.dumps(output))
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())